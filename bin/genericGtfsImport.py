@@ -5,10 +5,124 @@
 
 import sqlite3
 import os
+import sys
 import re
 import argparse
+import hashlib
+import heapq
 import json
+import io
+import time
 from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import chain, groupby, repeat
+from operator import itemgetter
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+def write_routes(routes, out_file, ndjson=False):
+    """Write routes to out_file as a JSON array, one route at a time.
+
+    With ndjson=True, write one route per line instead (newline-delimited JSON).
+    The output goes to a temporary file that replaces out_file only when complete,
+    so readers never see a partially written file.
+    Returns the number of routes written.
+    """
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            if ndjson:
+                for route in routes:
+                    f.write(json.dumps(route, ensure_ascii=False))
+                    f.write("\n")
+                    count += 1
+            else:
+                # same output as json.dump
+                f.write("[")
+                for route in routes:
+                    if count:
+                        f.write(", ")
+                    f.write(json.dumps(route, ensure_ascii=False))
+                    count += 1
+                f.write("]")
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return count
+
+def read_routes(catalog_file):
+    """Read the routes of a catalog written by write_routes, either a JSON array or newline-delimited JSON"""
+    with open(catalog_file, encoding='utf-8') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            return json.load(f)
+        return [json.loads(line) for line in f if line.strip()]
+
+@lru_cache(maxsize=1 << 16)
+def natural_sort_key(s):
+    """Sort key for strings that compares the numbers in them by value, e.g. "T53-E2" -> ('T', 53, '-E', 2, '')
+
+    Cached, because the same refs appear in many routes.
+    """
+    # separate numbers and non-numbers
+    # examples:
+    # "532" -> ['', '532', '']
+    # "A" -> ['A']
+    # "2B" -> ['', '2', 'B']
+    split = re.split(r'(\d+)', s)
+    # convert number strings to numbers
+    split[1::2] = [int(x) for x in split[1::2]]
+    return tuple(split)
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+def active_service_ids(calendar, calendar_dates, first_date, last_date):
+    """The service_ids that run on at least one day from first_date to last_date (datetime.date, inclusive).
+
+    calendar and calendar_dates are iterables of rows (mappings) of calendar.txt and calendar_dates.txt, either may be empty.
+    A service runs on a day if calendar_dates adds it (exception_type 1), or if calendar has it on that weekday
+    within start_date..end_date and calendar_dates doesn't remove it (exception_type 2).
+    """
+    first = first_date.strftime('%Y%m%d')
+    last = last_date.strftime('%Y%m%d')
+    service_ids = set()
+    removed = set()
+    for row in calendar_dates:
+        day = str(row['date']).strip()
+        if not first <= day <= last:
+            continue
+        exception_type = str(row['exception_type']).strip()
+        if exception_type == '1':
+            service_ids.add(str(row['service_id']))
+        elif exception_type == '2':
+            removed.add((str(row['service_id']), day))
+
+    days = [first_date + timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+    days = [(day.strftime('%Y%m%d'), WEEKDAYS[day.weekday()]) for day in days]
+    for row in calendar:
+        service_id = str(row['service_id'])
+        if service_id in service_ids:
+            continue
+        start_date = str(row['start_date']).strip()
+        end_date = str(row['end_date']).strip()
+        for day, weekday in days:
+            if start_date <= day <= end_date and str(row[weekday]).strip() == '1' and (service_id, day) not in removed:
+                service_ids.add(service_id)
+                break
+    return service_ids
 
 def sqlite3_connect_read_only(filename):
     # use the recipe at https://www.sqlite.org/uri.html#the_uri_path to open the file with a read-only URI
@@ -26,6 +140,205 @@ def sqlite3_connect_read_only(filename):
     print(f"sqlite3.connect({uri!r}, uri=True)")
     return sqlite3.connect(uri, uri=True)
 
+def available_cpus():
+    """Number of CPUs this process can run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class CachedNormalizer:
+    """A string normalization function with a bounded cache of its results.
+
+    GTFS names (stop names, headsigns, agency names...) repeat many times in a feed, so a normalization
+    function usually sees the same few thousand strings over and over. Call it like the function it wraps.
+    hits and misses count the calls that were and weren't answered from the cache.
+    """
+    def __init__(self, normalize, maxsize=1 << 16):
+        self.normalize = normalize
+        self._cached = lru_cache(maxsize=maxsize)(normalize)
+
+    def __call__(self, s):
+        return self._cached(s)
+
+    @property
+    def hits(self):
+        return self._cached.cache_info().hits
+
+    @property
+    def misses(self):
+        return self._cached.cache_info().misses
+
+    def report(self):
+        print(f"{self.normalize.__name__}: {self.hits} cache hits, {self.misses} cache misses")
+
+    def cache_clear(self):
+        self._cached.cache_clear()
+
+class RecordView:
+    """Read-only view of a compact record (a tuple) that works like sqlite3.Row.
+
+    columns maps column names to indexes in the record, and is shared by all records of the same query.
+    Like sqlite3.Row, iterating gives the values, and keys() gives the column names.
+    """
+    __slots__ = ('_columns', '_record')
+
+    def __init__(self, columns, record):
+        self._columns = columns
+        self._record = record
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._record[key]
+        if key in self._columns:
+            return self._record[self._columns[key]]
+        # like sqlite3.Row, column names are case-insensitive
+        for name, i in self._columns.items():
+            if name.lower() == key.lower():
+                return self._record[i]
+        raise IndexError("No item with that key")
+
+    def __iter__(self):
+        return iter(self._record)
+
+    def __len__(self):
+        return len(self._record)
+
+    def __eq__(self, other):
+        if not isinstance(other, RecordView):
+            return NotImplemented
+        return list(self.keys()) == list(other.keys()) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash((tuple(self.keys()), tuple(self)))
+
+    def keys(self):
+        return list(self._columns)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(zip(self.keys(), self))!r})"
+
+class TripView(MutableMapping):
+    """View of a trip record with stops that works like the dict with a 'stops' key that property functions used to get.
+
+    The 'stops' list holds RecordViews of the stop records. It is made on first access and kept.
+    Like that dict, keys can be set and deleted. The changes are kept on top of the record, which is never changed,
+    because the records of trips with the same stop pattern share their stop records.
+    """
+    __slots__ = ('_columns', '_record', '_stop_columns', '_stops', '_changes')
+
+    _deleted = object()
+    """Marks a deleted key of the record in _changes"""
+
+    def __init__(self, columns, record, stop_columns):
+        self._columns = columns
+        self._record = record
+        self._stop_columns = stop_columns
+        self._stops = None
+        self._changes = None
+
+    def __getitem__(self, key):
+        if self._changes is not None and key in self._changes:
+            value = self._changes[key]
+            if value is TripView._deleted:
+                raise KeyError(key)
+            return value
+        if key == 'stops':
+            if self._stops is None:
+                self._stops = [RecordView(self._stop_columns, stop) for stop in self._record[self._columns[key]]]
+            return self._stops
+        return self._record[self._columns[key]]
+
+    def __setitem__(self, key, value):
+        if self._changes is None:
+            self._changes = {}
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        self[key] # raises KeyError if there is no such key
+        if key in self._columns:
+            self.__setitem__(key, TripView._deleted)
+        else:
+            del self._changes[key]
+
+    def __iter__(self):
+        if self._changes is None:
+            return iter(self._columns)
+        # the keys of the record, then the new keys in the order they were set, like in a dict
+        keys = chain(self._columns, (key for key in self._changes if key not in self._columns))
+        return (key for key in keys if self._changes.get(key) is not TripView._deleted)
+
+    def __len__(self):
+        if self._changes is None:
+            return len(self._columns)
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+class TripRecords(list):
+    """List of a route's trips as compact records, along with the column->index maps for trips and stops.
+
+    Trip records are tuples of the trips query columns. If stops are included, the last item of a trip record
+    is its list of stop records, which are tuples of the stop_times query columns, and trip_columns has a 'stops' key for it.
+    """
+    __slots__ = ('trip_columns', 'stop_columns')
+
+    def __init__(self, trip_columns, stop_columns=None):
+        super().__init__()
+        self.trip_columns = trip_columns
+        self.stop_columns = stop_columns
+
+    def views(self):
+        """The trips as views that work like sqlite3.Row, or like dict if they have stops, as documented for property functions in set_route_property"""
+        if self.stop_columns is None:
+            return [RecordView(self.trip_columns, trip) for trip in self]
+        return [TripView(self.trip_columns, trip, self.stop_columns) for trip in self]
+
+class QueryRows:
+    """The rows of a query cursor, fetched in batches while measuring the time spent in SQLite.
+
+    Returned by PtnaRoutesImporter._run_query_phase instead of the cursor, with the same description attribute.
+    The rows can be iterated once. When they run out, the time spent executing the query and fetching its rows
+    is reported as the query's phase, along with the number of rows.
+    """
+    batch_size = 1000
+
+    def __init__(self, importer, name, cursor, execute_time):
+        self._importer = importer
+        self._name = name
+        self._cursor = cursor
+        self.description = cursor.description
+        self.wall_time = execute_time
+        self.rows = 0
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            batch = self._cursor.fetchmany(self.batch_size)
+            fetch_time = time.perf_counter() - start
+            self.wall_time += fetch_time
+            self._importer._query_time += fetch_time
+            if not batch:
+                break
+            self.rows += len(batch)
+            yield from batch
+        self._importer._phase_done(self._name, self.wall_time, self.rows)
+
+class RouteSummary(dict):
+    """A route's row of the ptna_route_summary table, used instead of its trips when all route properties can be answered from it.
+
+    Maps the keys of _get_route_values (see PtnaRoutesImporter.route_summary_columns) to lists of distinct values.
+    """
+    __slots__ = ()
+
+def _columns_index(cursor):
+    """Map column names of a query to their index in the result tuples"""
+    columns = {}
+    for i, column in enumerate(cursor.description):
+        # the first column of each name, like sqlite3.Row
+        columns.setdefault(column[0], i)
+    return columns
+
 class PtnaRoutesImporter:
     """Class to import routes from GTFS and output them in .json to be injected to PTNA CSV.
 
@@ -55,49 +368,442 @@ class PtnaRoutesImporter:
         """
     """SQL query to get stop_times - must produce exactly one row per stop_time, must include trip_id, stop_sequence"""
 
-    def __init__(self, gtfs_feed, dbfile):
+    covering_indexes = {
+        'trips': ["route_id, trip_id", "trip_id"],
+        'stop_times': ["trip_id, CAST(stop_sequence AS INTEGER), stop_id"],
+    }
+    """Indexes for use_index_database, by table name. The columns of these indexes are copied to the side database, with these indexes."""
+
+    route_summary_columns = {
+        'trip_headsign': 'trip_headsign',
+        'direction_id': 'direction_id',
+        ('from', 'trip_headsign'): 'from_trip_headsign',
+        ('to', 'trip_headsign'): 'to_trip_headsign',
+        ('from', 'stop_name'): 'from_stop_name',
+        ('to', 'stop_name'): 'to_stop_name',
+    }
+    """Columns of the ptna_route_summary table made by gtfs-summarize-ptna-sqlite.sh, by the keys of _get_route_values they answer"""
+
+    def __init__(self, gtfs_feed, dbfile, streaming=False, jobs=1):
         self.gtfs_feed = gtfs_feed
-        self._con = sqlite3_connect_read_only(dbfile)
-        self._con.row_factory = sqlite3.Row
+        self.dbfile = dbfile
+        self.streaming = streaming
+        self.jobs = jobs
+        self.index_database = None
+        self.report_query_plans = False
+        self._reported_queries = set()
+        self.metrics = []
+        self._query_time = 0
+        self._selected_route_ids = None
+        self.active_dates = None
+        self.use_route_summary = True
+        self.share_stop_patterns = True
+        self._pattern_trip_by_trip_id = None
+        self._connect()
         self.route_properties = {}
+        self._parsed_sources = {}
+        self._field_tables = {}
         self.add_default_route_properties()
 
+    def _connect(self):
+        self._con = sqlite3_connect_read_only(self.dbfile)
+        self._con.row_factory = sqlite3.Row
+        if self.index_database:
+            self._attach_index_database()
+        if self.active_dates:
+            self._create_active_service_ids(self._con)
+
     def __del__(self):
-        self._con.close()
+        if self._con:
+            self._con.close()
+
+    def __getstate__(self):
+        # for multiprocessing - each process opens its own connection, see _convert_routes_chunk
+        state = self.__dict__.copy()
+        state['_con'] = None
+        state['_selected_route_ids'] = None
+        state['_pattern_trip_by_trip_id'] = None
+        return state
+
+    def use_index_database(self, filename):
+        """Use indexed copies of tables from a side database, to get index lookups instead of table scans and sorting.
+
+        Only the columns used by the indexes in covering_indexes are copied to the side database (which is created if needed),
+        along with the rowid of each row and the indexes. That is still about the size of the stop_times table without its times.
+        The copies are made again if the database file has changed since.
+        The database itself is opened read-only and never changed. The copies are used through temporary views
+        with the same names as the tables, which get the other columns from the database by rowid,
+        so the queries don't need to change. Queries that only use the copied columns don't read the database tables at all.
+
+        This helps the queries that are ordered or restricted to some routes: streaming, jobs, select_route_ids and set_active_dates.
+        A query that reads all of stop_times, like the default stop_times_query, is still a full scan - of the smaller copy.
+        """
+        self.index_database = filename
+        self._attach_index_database(create=True)
+
+    def _attach_index_database(self, create=False):
+        cur = self.get_cursor()
+        print(f"Attaching index database {self.index_database}")
+        cur.execute("ATTACH DATABASE ? AS ptna_index;", (self.index_database,))
+
+        columns_by_table = {table: [row['name'] for row in cur.execute(f"PRAGMA main.table_info({table});")] for table in self.covering_indexes}
+        key_columns_by_table = {table: [column for column in columns if any(re.search(rf"\b{re.escape(column)}\b", index) for index in self.covering_indexes[table])]
+            for table, columns in columns_by_table.items()}
+
+        if create:
+            db_stat = os.stat(self.dbfile)
+            source = (os.path.abspath(self.dbfile), db_stat.st_size, int(db_stat.st_mtime), repr((self.covering_indexes, key_columns_by_table)))
+            cur.execute("CREATE TABLE IF NOT EXISTS ptna_index.ptna_index_source (db_file TEXT, db_size INTEGER, db_mtime INTEGER, covering_indexes TEXT);")
+            if [tuple(row) for row in cur.execute("SELECT * FROM ptna_index.ptna_index_source;")] != [source]:
+                print(f"Copying index columns to index database: {', '.join(self.covering_indexes)}")
+                for table, indexes in self.covering_indexes.items():
+                    key_columns = ', '.join(key_columns_by_table[table])
+                    cur.execute(f"DROP TABLE IF EXISTS ptna_index.{table};")
+                    cur.execute(f"CREATE TABLE ptna_index.{table} AS SELECT rowid AS ptna_rowid, {key_columns} FROM main.{table};")
+                    for i, columns in enumerate(indexes):
+                        print(f"\tCREATE INDEX ON {table} ({columns})")
+                        cur.execute(f"CREATE INDEX ptna_index.idx_ptna_{table}_{i} ON {table} ({columns});")
+                # without statistics, SQLite may prefer scanning the small copy of stop_times to using the indexes
+                cur.execute("ANALYZE ptna_index;")
+                cur.execute("DELETE FROM ptna_index.ptna_index_source;")
+                cur.execute("INSERT INTO ptna_index.ptna_index_source VALUES (?, ?, ?, ?);", source)
+                self._con.commit()
+            else:
+                print("Index database is up to date")
+
+        for table, columns in columns_by_table.items():
+            # temp objects are looked up before main, so the queries get the copy
+            # the LEFT JOIN by rowid is left out by SQLite when a query uses none of the other columns
+            # (the copy keeps the table name as alias, for report_query_plan)
+            view_columns = ', '.join(f"{table if column in key_columns_by_table[table] else 'main_' + table}.{column} AS {column}" for column in columns)
+            cur.execute(f"""CREATE TEMP VIEW IF NOT EXISTS {table} AS
+                SELECT {view_columns}
+                FROM ptna_index.{table} AS {table}
+                LEFT JOIN main.{table} AS main_{table} ON main_{table}.rowid = {table}.ptna_rowid;""")
+
+    def report_query_plan(self, query):
+        """Print the parts of the query plan that are likely to be slow: full table scans and temp B-trees for sorting.
+
+        Only if report_query_plans is set, and only once for each query. See use_index_database for a way to avoid them.
+        """
+        if not self.report_query_plans or query in self._reported_queries:
+            return
+        self._reported_queries.add(query)
+        cur = self.get_cursor()
+        tables = set()
+        for database in cur.execute("PRAGMA database_list;").fetchall():
+            schema = database['name']
+            tables |= {row['name'] for row in cur.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table';")}
+
+        problems = []
+        for row in cur.execute(f"EXPLAIN QUERY PLAN {query}"):
+            detail = row['detail']
+            if scan := re.fullmatch(r"SCAN (?:\w+\.)?(\w+)", detail):
+                # a scan without an index - unless it's a subquery
+                if scan.group(1) in tables:
+                    problems.append(f"full table scan of {scan.group(1)}")
+            elif "TEMP B-TREE" in detail:
+                problems.append(detail.lower().replace("use temp b-tree", "temp B-tree"))
+        if problems:
+            print(f"Query plan: {'; '.join(problems)}")
+        else:
+            print("Query plan: no full table scans or temp B-trees")
+
+    def select_route_ids(self, route_ids):
+        """Restrict the routes, trips and stop_times queries to the given route_ids"""
+        self._selected_route_ids = list(route_ids)
+        cur = self.get_cursor()
+        # temp tables can be created even though the database is opened read-only
+        cur.execute("DROP TABLE IF EXISTS temp.ptna_selected_route_ids;")
+        cur.execute("CREATE TEMP TABLE ptna_selected_route_ids (route_id TEXT PRIMARY KEY);")
+        cur.executemany("INSERT OR IGNORE INTO temp.ptna_selected_route_ids (route_id) VALUES (?);", ((route_id,) for route_id in self._selected_route_ids))
+
+    def set_active_dates(self, first_date, last_date):
+        """Only use the trips that run on at least one day from first_date to last_date (datetime.date, inclusive).
+
+        The service_ids that run on those days are found in the calendar and calendar_dates tables
+        (see active_service_ids), and the routes, trips and stop_times queries are restricted to their trips,
+        so trips that were superseded or haven't started yet don't affect the routes.
+        Routes without any such trips are left out. trips_query must include service_id.
+        """
+        self.active_dates = (first_date, last_date)
+        self._create_active_service_ids(self._con)
+
+    def _create_active_service_ids(self, con):
+        """Create the temp table of active service_ids for set_active_dates on the database connection con"""
+        cur = con.cursor()
+        cur.row_factory = sqlite3.Row
+        tables = {row['name'] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        if not tables & {'calendar', 'calendar_dates'}:
+            raise ValueError("Active dates require a calendar or calendar_dates table")
+        calendar = cur.execute("SELECT * FROM calendar;").fetchall() if 'calendar' in tables else []
+        calendar_dates = cur.execute("SELECT * FROM calendar_dates;").fetchall() if 'calendar_dates' in tables else []
+        service_ids = active_service_ids(calendar, calendar_dates, *self.active_dates)
+        print(f"{len(service_ids)} service_ids active from {self.active_dates[0]} to {self.active_dates[1]}")
+        cur.execute("DROP TABLE IF EXISTS temp.ptna_active_service_ids;")
+        cur.execute("CREATE TEMP TABLE ptna_active_service_ids (service_id TEXT PRIMARY KEY);")
+        cur.executemany("INSERT INTO temp.ptna_active_service_ids (service_id) VALUES (?);", ((service_id,) for service_id in service_ids))
 
     def get_cursor(self):
         """Get a new cursor for the sqlite3 database"""
         return self._con.cursor()
 
+    def get_record_cursor(self):
+        """Get a new cursor for the sqlite3 database that returns plain tuples instead of sqlite3.Row
+
+        Used for trips and stops, of which there are many. Columns are accessed by index, see TripRecords.
+        """
+        cur = self.get_cursor()
+        cur.row_factory = None
+        return cur
+
     def get_sql_routes(self):
         """Queries SQL and returns an iterable of of route rows.
 
         You can override this to use custom logic, but for SQL query tweaks you should simply override the routes_query attribute.
         """
+        query = self._wrap_query(self.routes_query, self._route_conditions(), "route_id" if self.streaming else None)
         print("Running SQL query for routes:")
-        print(self.routes_query)
+        print(query)
+        self.report_query_plan(query)
         cur = self.get_cursor()
-        return cur.execute(self.routes_query)
+        return cur.execute(query)
 
     def get_sql_trips(self):
         """Queries SQL and returns an iterable of of trip rows.
 
         You can override this to use custom logic, but for SQL query tweaks you should simply override the trips_query attribute.
         """
+        query = self._wrap_query(self.trips_query, self._trip_conditions(), "route_id, trip_id" if self.streaming else None)
         print("Running SQL query for trips:")
-        print(self.trips_query)
-        cur = self.get_cursor()
-        return cur.execute(self.trips_query)
+        print(query)
+        self.report_query_plan(query)
+        cur = self.get_record_cursor()
+        return cur.execute(query)
 
     def get_sql_stop_times(self):
         """Queries SQL and returns an iterable of of stop_time rows.
 
         You can override this to use custom logic, but for SQL query tweaks you should simply override the stop_times_query attribute.
         """
+        query = self._stop_times_query()
         print("Running SQL query for stop_times/stops:")
-        print(self.stop_times_query)
+        print(query)
+        self.report_query_plan(query)
+        cur = self.get_record_cursor()
+        return cur.execute(query)
+
+    def get_sql_route_summary(self):
+        """Queries SQL and returns an iterable of ptna_route_summary rows. Used instead of the trips and stop_times queries, see _route_summary_usable."""
+        query = self._wrap_query("SELECT * FROM main.ptna_route_summary;", self._route_conditions())
+        print("Running SQL query for route summary:")
+        print(query)
+        cur = self.get_cursor()
+        return cur.execute(query)
+
+    def _route_summary_usable(self, sql_routes_columns, con=None):
+        """Whether all route properties can be answered from the ptna_route_summary table, so the trips and stop_times queries can be skipped.
+
+        The table is made from the routes, trips, stop_times and stops tables by gtfs-summarize-ptna-sqlite.sh, so it's only used
+        with the default trips and stop_times queries and without active dates. It's also only used while it's up to date:
+        the triggers made with it mark ptna_route_summary_source as stale when those tables change, and the dates of the
+        ptna table have to be the same as when it was made. Set use_route_summary to False to never use it.
+        con is the database connection to check, by default the one of the importer.
+        """
+        if not self.use_route_summary or self.active_dates:
+            return False
+        if self.trips_query != PtnaRoutesImporter.trips_query or self.stop_times_query != PtnaRoutesImporter.stop_times_query:
+            return False
+        for property_name, source in self.route_properties.items():
+            if not isinstance(source, str):
+                if source[1]:
+                    # function that gets trips
+                    return False
+                continue
+            for field in self._parse_source(source)[0]:
+                if field not in sql_routes_columns and field not in self.route_summary_columns and (property_name, field) not in self.route_summary_columns:
+                    return False
+
+        cur = con.cursor() if con else self.get_cursor()
+        names = {row[0] for row in cur.execute("SELECT name FROM main.sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE 'ptna%';")}
+        if 'ptna_route_summary_source' not in names or 'stale' not in {column[1] for column in cur.execute("PRAGMA main.table_info(ptna_route_summary_source);")}:
+            return False
+        triggers = {f"ptna_route_summary_{table}_{action}" for table in ('routes', 'trips', 'stops', 'stop_times') for action in ('insert', 'update', 'delete')}
+        if not triggers <= names:
+            # without the triggers, changes of the tables would go unnoticed
+            print("ptna_route_summary has no triggers, not using it")
+            return False
+        source = cur.execute("SELECT stale, prepared, aggregated, analyzed, normalized, release_date FROM main.ptna_route_summary_source;").fetchone()
+        dates = ('', '', '', '', '')
+        if 'ptna' in names:
+            dates = cur.execute("SELECT prepared, aggregated, analyzed, normalized, release_date FROM main.ptna WHERE id = 1;").fetchone() or dates
+        if source is None or source[0] or tuple(source[1:]) != tuple(dates):
+            print("ptna_route_summary is out of date, not using it")
+            return False
+        return True
+
+    def get_sql_stop_patterns(self):
+        """Queries SQL and returns an iterable of (trip_id, stop_pattern) rows, one for each trip that has stop_times.
+
+        Trips have the same stop_pattern if and only if they have the same stop_sequences and stop_ids.
+        The order of group_concat is only defined with ORDER BY, which needs SQLite 3.44. Without it, equal stop_patterns
+        still mean the same stops, because each stop_id comes with its stop_sequence, and get_trips puts the stops in
+        stop_sequence order. Trips with the same stops could only get different stop_patterns, and not share their stops.
+        """
+        order_by = " ORDER BY CAST(stop_sequence AS INTEGER)" if sqlite3.sqlite_version_info >= (3, 44, 0) else ""
+        query = f"""
+        SELECT trip_id, group_concat(quote(stop_sequence) || ' ' || quote(stop_id), ','{order_by}) AS stop_pattern
+        FROM stop_times
+        """
+        trip_conditions = self._trip_conditions()
+        if trip_conditions:
+            query += f"WHERE trip_id IN (SELECT trip_id FROM ({self._subquery(self._wrap_query(self.trips_query, trip_conditions))}))\n        "
+        query += "GROUP BY trip_id\n        ;\n        "
+        print("Running SQL query for stop patterns:")
+        print(query)
+        self.report_query_plan(query)
+        cur = self.get_record_cursor()
+        return cur.execute(query)
+
+    def _stop_patterns_usable(self):
+        """Whether trips with the same stops can share one stops list, so stop_times only need to be read for one trip of each stop pattern.
+
+        Many trips of a route run the same stops at different times, and the times aren't used for routes.
+        The stop pattern only covers stop_sequence and stop_id, so it's only used with the default stop_times_query,
+        and not when a property function gets stops, which it could tell apart by trip_id. It's also not used when streaming.
+        Set share_stop_patterns to False to never use it.
+
+        The ptna_trips table isn't used for this, because it has the trips that were aggregated
+        into the trips that remain in the trips table, not the stop patterns of those.
+        """
+        if not self.share_stop_patterns or self.streaming:
+            return False
+        if self.stop_times_query != PtnaRoutesImporter.stop_times_query:
+            return False
+        return not self._functions_get_stops()
+
+    def _create_pattern_trip_ids(self):
+        """Find one trip for each stop pattern (see get_sql_stop_patterns) and put them in a temp table, which _stop_times_query selects.
+
+        Sets _pattern_trip_by_trip_id, which get_trips uses to give each trip the stops of the trip of its stop pattern.
+        """
+        pattern_trip_ids = {}
+        self._pattern_trip_by_trip_id = {trip_id: pattern_trip_ids.setdefault(stop_pattern, trip_id)
+            for trip_id, stop_pattern in self.get_sql_stop_patterns()}
+        print(f"{len(pattern_trip_ids)} stop patterns for {len(self._pattern_trip_by_trip_id)} trips")
         cur = self.get_cursor()
-        return cur.execute(self.stop_times_query)
+        cur.execute("DROP TABLE IF EXISTS temp.ptna_pattern_trip_ids;")
+        # no column type, so trip_ids keep the type they have in stop_times
+        cur.execute("CREATE TEMP TABLE ptna_pattern_trip_ids (trip_id PRIMARY KEY);")
+        cur.executemany("INSERT INTO temp.ptna_pattern_trip_ids (trip_id) VALUES (?);", ((trip_id,) for trip_id in pattern_trip_ids.values()))
+        return len(self._pattern_trip_by_trip_id)
+
+    def get_sql_trip_endpoints(self):
+        """Queries SQL and returns an iterable of stop_time rows, only for the first and last stop of each trip.
+
+        Used instead of get_sql_stop_times when stops are only needed for "from" and "to" (see _from_to_handler).
+        The rows have the same fields as the ones from get_sql_stop_times - if you override that, override this too.
+        """
+        query = self._stop_times_query(endpoints_only=True)
+        print("Running SQL query for first and last stop_times/stops of each trip:")
+        print(query)
+        self.report_query_plan(query)
+        cur = self.get_record_cursor()
+        return cur.execute(query)
+
+    def _stop_times_query(self, endpoints_only=False):
+        """Build the query for get_sql_stop_times and get_sql_trip_endpoints out of stop_times_query"""
+        trip_conditions = self._trip_conditions()
+        pattern_trips = not endpoints_only and self._pattern_trip_by_trip_id is not None
+        if not endpoints_only and not self.streaming and not trip_conditions and not pattern_trips:
+            return self.stop_times_query
+
+        stop_sequence = "CAST(stop_times_query.stop_sequence AS INTEGER)"
+        joins = []
+        conditions = []
+        order_by = None
+        if endpoints_only:
+            # let SQL find the first and last stop_sequence of each trip, so we don't get all the stops in between.
+            # the default stop_times_query has one row for each row of stop_times, so that's enough without stops,
+            # and only for the trips that are wanted - the JOIN with trips_query below doesn't restrict this
+            endpoints_source = "stop_times" if self.stop_times_query == PtnaRoutesImporter.stop_times_query else f"({self._subquery(self.stop_times_query)})"
+            endpoints_conditions = ""
+            if trip_conditions:
+                endpoints_conditions = f"""
+            WHERE trip_id IN (SELECT trip_id FROM ({self._subquery(self._wrap_query(self.trips_query, trip_conditions))}))"""
+            joins.append(f"""JOIN (
+            SELECT trip_id, MIN(CAST(stop_sequence AS INTEGER)) AS first_stop_sequence, MAX(CAST(stop_sequence AS INTEGER)) AS last_stop_sequence
+            FROM {endpoints_source}{endpoints_conditions}
+            GROUP BY trip_id
+        ) AS trip_endpoints ON trip_endpoints.trip_id = stop_times_query.trip_id""")
+            conditions.append(f"{stop_sequence} IN (trip_endpoints.first_stop_sequence, trip_endpoints.last_stop_sequence)")
+        if pattern_trips:
+            # the other trips share their stops, see _create_pattern_trip_ids - these are already restricted by trip_conditions.
+            # not a JOIN, with which SQLite scans stop_times instead of looking up the trip_ids in its index
+            conditions.append("stop_times_query.trip_id IN (SELECT trip_id FROM temp.ptna_pattern_trip_ids)")
+        elif self.streaming or trip_conditions:
+            # stop_times has no route_id, so borrow it from the trips query - to get the same order as get_sql_trips,
+            # and the same trips
+            trips_query = self._subquery(self._wrap_query(self.trips_query, trip_conditions))
+            joins.append(f"JOIN ({trips_query}) AS trips_query ON trips_query.trip_id = stop_times_query.trip_id")
+        if self.streaming:
+            order_by = f"trips_query.route_id, stop_times_query.trip_id, {stop_sequence}"
+
+        query = f"""
+        SELECT stop_times_query.*
+        FROM ({self._subquery(self.stop_times_query)}) AS stop_times_query
+        """
+        for join in joins:
+            query += f"{join}\n        "
+        if conditions:
+            query += f"WHERE {' AND '.join(conditions)}\n        "
+        if order_by:
+            query += f"ORDER BY {order_by}\n        "
+        return query + ";\n        "
+
+    @staticmethod
+    def _subquery(query):
+        """Strip a configured query of its trailing semicolon so it can be nested in another query"""
+        return query.strip().rstrip(';').strip()
+
+    def _wrap_query(self, query, conditions=(), order_by=None):
+        """Wrap a configured query to filter and/or sort its results. Returns the query as is if there's nothing to add."""
+        if not conditions and not order_by:
+            return query
+        query = f"""
+        SELECT *
+        FROM ({self._subquery(query)})
+        """
+        if conditions:
+            query += f"WHERE {' AND '.join(conditions)}\n        "
+        if order_by:
+            query += f"ORDER BY {order_by}\n        "
+        return query + ";\n        "
+
+    def _route_conditions(self):
+        """SQL conditions to restrict a query with a route_id column to the routes given to select_route_ids,
+        and to routes with active trips (see set_active_dates)"""
+        conditions = []
+        if self._selected_route_ids is not None:
+            conditions.append("route_id IN (SELECT route_id FROM temp.ptna_selected_route_ids)")
+        return conditions + self._active_route_conditions()
+
+    def _trip_conditions(self):
+        """SQL conditions to restrict the trips query to the trips of the selected routes that are active"""
+        conditions = []
+        if self._selected_route_ids is not None:
+            conditions.append("route_id IN (SELECT route_id FROM temp.ptna_selected_route_ids)")
+        return conditions + self._active_trip_conditions()
+
+    def _active_route_conditions(self):
+        if not self.active_dates:
+            return []
+        return [f"route_id IN (SELECT route_id FROM ({self._subquery(self._wrap_query(self.trips_query, self._active_trip_conditions()))}))"]
+
+    def _active_trip_conditions(self):
+        if not self.active_dates:
+            return []
+        return ["service_id IN (SELECT service_id FROM temp.ptna_active_service_ids)"]
 
     def get_gtfs_feed(self, *args, **kwargs):
         return self.gtfs_feed
@@ -169,35 +875,133 @@ class PtnaRoutesImporter:
         """Remove a route property_name - basically undo set_route_property"""
         del self.route_properties[property_name]
 
-    def _get_property(self, gtfs_route, gtfs_trips, property_name, source):
+    def _parse_source(self, source):
+        """Cached split_source - sources are parsed once, not once per route"""
+        parsed = self._parsed_sources.get(source)
+        if parsed is None:
+            parsed = self._parsed_sources[source] = self.split_source(source)
+        return parsed
+
+    def _field_table(self, field, gtfs_route, gtfs_trips):
+        """Which query a field comes from: 'routes', 'trips' or 'stops'.
+
+        Normally already known from _get_routes_and_trips, otherwise it's figured out from the rows and remembered.
+        Returns None if it can't be known because the route has no trips.
+        """
+        table = self._field_tables.get(field)
+        if table:
+            return table
+        if field in gtfs_route.keys():
+            table = 'routes'
+        elif not gtfs_trips:
+            return None
+        elif isinstance(gtfs_trips, TripRecords):
+            table = 'trips' if field in gtfs_trips.trip_columns else 'stops'
+        elif field in gtfs_trips[0].keys():
+            table = 'trips'
+        elif not gtfs_trips[0]['stops'] or field in gtfs_trips[0]['stops'][0].keys():
+            table = 'stops'
+        else:
+            trip = gtfs_trips[0]
+            stop = trip['stops'][0]
+            raise KeyError(f"Column {field!r} for a route property could not be found in any of the SQL queries. "
+                "The available columns for routes, trips, and stops respectively:",
+                list(gtfs_route.keys()), list(trip.keys()), list(stop.keys()))
+        self._field_tables[field] = table
+        return table
+
+    def _get_route_values(self, gtfs_route, gtfs_trips):
+        """Collect the values of all trips and stops columns used by string route properties, in one pass over the route's trips.
+
+        Returns a dict mapping a column name to the set of its values in this route.
+        Columns handled by _from_to_handler are also collected under a (property_name, field) key.
+        """
+        trip_fields = set()
+        stop_fields = set()
+        from_to_keys = set()
+        for property_name, source in self.route_properties.items():
+            if not isinstance(source, str):
+                continue
+            for field in self._parse_source(source)[0]:
+                if property_name in ['from', 'to'] and field in self._from_to_fields:
+                    from_to_keys.add((property_name, field))
+                    if field == 'stop_name':
+                        # only looked up as a normal column if the route has no trips
+                        continue
+                table = self._field_table(field, gtfs_route, gtfs_trips)
+                if table == 'trips':
+                    trip_fields.add(field)
+                elif table == 'stops':
+                    stop_fields.add(field)
+
+        route_values = {key: set() for key in trip_fields | stop_fields | from_to_keys}
+        if isinstance(gtfs_trips, RouteSummary):
+            for key, values in route_values.items():
+                values.update(gtfs_trips.get(key, ()))
+            return route_values
+        if not gtfs_trips:
+            return route_values
+
+        if isinstance(gtfs_trips, TripRecords):
+            # compact records are accessed by index
+            trip_key = gtfs_trips.trip_columns.__getitem__
+            stop_key = gtfs_trips.stop_columns.__getitem__ if gtfs_trips.stop_columns else None
+        else:
+            trip_key = stop_key = lambda field: field
+
+        trip_values = [(trip_key(trip_field), route_values[trip_field]) for trip_field in trip_fields]
+        stop_values = [(stop_key(stop_field), route_values[stop_field]) for stop_field in stop_fields]
+        # see _from_to_handler for the logic
+        # 'to' takes trip_headsign from trips going the normal way, 'from' takes from trips going the other way
+        headsigns_by_direction = {direction_id: route_values[key]
+            for key, direction_id in [(('from', 'trip_headsign'), '1'), (('to', 'trip_headsign'), '0')] if key in route_values}
+        # 'to' takes stop_name from the last stop in each trip, 'from' takes from the first stop
+        endpoint_values = [(i, route_values[key])
+            for key, i in [(('from', 'stop_name'), 0), (('to', 'stop_name'), -1)] if key in route_values]
+        if headsigns_by_direction:
+            direction_id_key = trip_key('direction_id')
+            trip_headsign_key = trip_key('trip_headsign')
+        if stop_values or endpoint_values:
+            stops_key = trip_key('stops')
+        if endpoint_values:
+            stop_name_key = stop_key('stop_name')
+
+        # trips with the same stops may share one stops list (see _stop_patterns_usable), so each list is only looked at once
+        seen_stops = set()
+        for trip in gtfs_trips:
+            for key, values in trip_values:
+                values.add(trip[key])
+            if headsigns_by_direction and trip[direction_id_key] in headsigns_by_direction:
+                headsigns_by_direction[trip[direction_id_key]].add(trip[trip_headsign_key])
+            if stop_values or endpoint_values:
+                stops = trip[stops_key]
+                if id(stops) in seen_stops:
+                    continue
+                seen_stops.add(id(stops))
+                for stop in stops:
+                    for key, values in stop_values:
+                        values.add(stop[key])
+                for i, values in endpoint_values:
+                    values.add(stops[i][stop_name_key])
+        return route_values
+
+    def _get_property(self, gtfs_route, gtfs_trips, property_name, source, route_values, trip_views=None):
         if isinstance(source, str):
-            fields, delim = self.split_source(source)
+            fields, delim = self._parse_source(source)
 
             values = set()
             for field in fields:
                 if property_name in ['from', 'to']:
                     # special case
-                    if vals := self._from_to_handler(property_name, field, gtfs_route, gtfs_trips):
+                    if vals := self._from_to_handler(property_name, field, route_values):
                         values |= vals
                         continue
                 if field in gtfs_route.keys():
                     # routes column
                     values.add(gtfs_route[field])
                     continue
-                # not a routes column, try trips
-                for trip in gtfs_trips:
-                    if field in trip.keys():
-                        values.add(trip[field])
-                        continue
-                    # not a trips column, must be a stops column
-                    for stop in trip['stops']:
-                        if field in stop.keys():
-                            values.add(stop[field])
-                            continue
-                        # this is supposed to be caught earlier but might as well raise it here if it managed to get this far
-                        raise KeyError(f"Column {field!r} for route property {property_name!r} could not be found in any of the SQL queries. "
-                            "The available columns for routes, trips, and stops respectively:",
-                            list(gtfs_route.keys()), list(trip.keys()), list(stop.keys()))
+                # trips or stops column, if the route has any trips
+                values |= route_values.get(field, set())
 
             values = {v.strip() for v in values if v and v.strip()}
             return delim.join(sorted(values))
@@ -205,62 +1009,219 @@ class PtnaRoutesImporter:
             # source is a function
             src, get_trips, get_stops = source
             if get_trips:
-                return src(property_name, gtfs_route, gtfs_trips)
+                return src(property_name, gtfs_route, gtfs_trips if trip_views is None else trip_views)
             else:
                 return src(property_name, gtfs_route)
 
-    def _from_to_handler(self, property_name, field, gtfs_route, gtfs_trips):
-        """Special logic to make more useful values for "from" and "to" fields"""
+    _from_to_fields = ('trip_headsign', 'stop_name')
+    """Fields with special handling in "from" and "to" properties"""
+
+    def _from_to_handler(self, property_name, field, route_values):
+        """Special logic to make more useful values for "from" and "to" fields
+
+        The values are collected by _get_route_values:
+        for trip_headsign, 'to' takes trip_headsign from trips going the normal way (direction_id 0),
+        'from' takes from trips going the other way (direction_id 1).
+        for stop_name, 'to' takes stop_name from the last stop in each trip, 'from' takes from the first stop.
+        Returns None if the field has no special handling.
+        """
         assert property_name in ['from', 'to']
-        match field:
-            case 'trip_headsign':
-                # 'to' takes trip_headsign from trips going the normal way
-                # 'from' takes from trips going the other way
-                direction_id = '1' if property_name == 'from' else '0'
-                return set(trip['trip_headsign'] for trip in gtfs_trips if trip['direction_id'] == direction_id)
-            case 'stop_name':
-                # 'to' takes stop_name from the last stop in each trip
-                # 'from' takes from the first stop
-                i = 0 if property_name == 'from' else -1
-                return set(trip['stops'][i]['stop_name'] for trip in gtfs_trips)
-            case _:
-                # no special handling
-                return None
-
-    def main(self, out_file):
-        """Query database, convert to routes, sort and create .json"""
+        return route_values.get((property_name, field))
+
+    def main(self, out_file, ndjson=False, route_hashes=False):
+        """Query database, convert to routes, sort and create .json (or newline-delimited .json)
+
+        With route_hashes, also write the route hashes file of out_file, so that it can be the previous_catalog of main_incremental.
+        """
         # TODO: filter by stops?
         print("Starting import process")
         self.get_routes()
         self.sort_routes()
-        self.output_routes(out_file)
+        self.output_routes(out_file, ndjson)
+        if route_hashes:
+            self.write_route_hashes(out_file, self.get_route_hashes(self._con))
+
+    def main_incremental(self, out_file, previous_catalog, ndjson=False):
+        """Like main, but only convert the routes that changed since a previous catalog, and reuse the rest from it.
+
+        previous_catalog is the output of this importer for an earlier release of the feed, with the same route properties.
+        Routes are compared by the hashes of their rows in the database (see get_route_hashes).
+        The hashes of the previous release are read from the route hashes file of previous_catalog (see route_hashes_file),
+        which is written next to out_file by this method, and by main if asked to.
+        If the route properties or queries changed since previous_catalog, or the file doesn't exist, so they can't be
+        compared, all routes are converted.
+        """
+        print("Starting incremental import process")
+        if self.route_properties.get('route_id') != 'route_id':
+            raise ValueError("Incremental import requires the route_id property, to match routes with the previous catalog")
+        route_hashes = self.get_route_hashes(self._con)
+
+        config, previous_hashes = self.read_route_hashes(previous_catalog)
+        if config is None:
+            print(f"{self.route_hashes_file(previous_catalog)} not found, converting all routes")
+            previous_hashes = {}
+        elif config != self._route_hashes_config():
+            print("Route properties or queries changed since the previous catalog, converting all routes")
+            previous_hashes = {}
+
+        changed_route_ids = [route_id for route_id, route_hash in route_hashes.items() if previous_hashes.get(route_id) != route_hash]
+        removed_count = len(previous_hashes.keys() - route_hashes.keys())
+        print(f"{len(route_hashes) - len(changed_route_ids)} unchanged routes, {len(changed_route_ids)} new or changed routes, {removed_count} removed routes")
+
+        print(f"Reading previous catalog {previous_catalog}")
+        changed = set(changed_route_ids)
+        previous_routes = [route for route in read_routes(previous_catalog) if route['route_id'] in route_hashes and route['route_id'] not in changed]
+
+        if changed_route_ids:
+            self.select_route_ids(changed_route_ids)
+            self.get_routes()
+        else:
+            self.routes = []
+            self._route_sort_key_by_route_id = {}
+        self.sort_routes()
+        self.merge_routes(previous_routes)
+        self.output_routes(out_file, ndjson)
+        self.write_route_hashes(out_file, route_hashes)
+
+    def report_phase(self, phase):
+        """Called at the end of each phase of the import with a dict of its metrics.
+
+        The phases are get_sql_routes, get_sql_trips, get_stop_patterns, get_sql_stop_times (or get_sql_trip_endpoints), get_trips
+        (or get_sql_route_summary and get_route_summary, see _route_summary_usable),
+        get_routes (which includes the ones before it), sort_routes and output_routes,
+        and for main_incremental also get_route_hashes and merge_routes.
+        The get_sql_* phases are the time spent in SQLite running the query and fetching its rows (see QueryRows).
+        They end when their rows have been read, which happens during get_trips or get_routes. get_trips and get_route_summary
+        don't include that time, so they are the time spent in Python. The keys of phase are:
+            phase - name of the phase
+            wall_time_s - duration in seconds
+            rows - number of rows processed, or None
+            rows_per_s - rows / wall_time_s, or None
+            peak_rss_kb - peak memory usage of the process so far, in KB, or None if unknown
+        Metrics of phases that ran in another process (see jobs) also have a 'chunk' key.
+        All metrics are also collected in self.metrics, see write_metrics.
+        Override this to do something else with the metrics - the default is to print them.
+        """
+        rows = f", {phase['rows']} rows ({phase['rows_per_s']:.0f} rows/s)" if phase['rows'] is not None else ""
+        rss = f", peak RSS {phase['peak_rss_kb'] // 1024} MB" if phase['peak_rss_kb'] is not None else ""
+        print(f"Phase {phase['phase']}: {phase['wall_time_s']:.3f}s{rows}{rss}")
+
+    def write_metrics(self, metrics_file):
+        """Write the metrics of all phases so far to a .json file"""
+        print(f"Writing metrics to {metrics_file}")
+        with open(metrics_file, 'w', encoding='utf-8') as f:
+            json.dump({'gtfs_feed': self.gtfs_feed, 'phases': self.metrics}, f, ensure_ascii=False, indent=1)
+
+    def _phase_done(self, name, wall_time, rows=None):
+        peak_rss_kb = None
+        if resource:
+            peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':
+                # bytes on macOS, KB on Linux
+                peak_rss_kb //= 1024
+        phase = {
+            'phase': name,
+            'wall_time_s': round(wall_time, 6),
+            'rows': rows,
+            'rows_per_s': rows / wall_time if rows is not None and wall_time > 0 else None,
+            'peak_rss_kb': peak_rss_kb,
+        }
+        self.metrics.append(phase)
+        self.report_phase(phase)
+
+    @contextmanager
+    def _phase(self, name, exclude_query_time=False):
+        """Measure a phase of the import. Set the 'rows' key of the yielded dict to report the number of rows.
+
+        If exclude_query_time is True, the time spent fetching query rows during the phase is not counted (see QueryRows).
+        """
+        counter = {'rows': None}
+        start = time.perf_counter()
+        query_time = self._query_time
+        yield counter
+        wall_time = time.perf_counter() - start
+        if exclude_query_time:
+            wall_time -= self._query_time - query_time
+        self._phase_done(name, wall_time, counter['rows'])
+
+    def _run_query_phase(self, get_sql):
+        """Call one of the get_sql_* methods, and return its rows as QueryRows that report a phase named after it"""
+        start = time.perf_counter()
+        cursor = get_sql()
+        execute_time = time.perf_counter() - start
+        self._query_time += execute_time
+        return QueryRows(self, get_sql.__name__, cursor, execute_time)
+
+    def _run_stop_times_query_phase(self):
+        """Run get_sql_stop_times as a phase, for only one trip of each stop pattern if possible (see _stop_patterns_usable)"""
+        if self._stop_patterns_usable():
+            with self._phase('get_stop_patterns') as phase:
+                phase['rows'] = self._create_pattern_trip_ids()
+        return self._run_query_phase(self.get_sql_stop_times)
 
     def get_routes(self):
         """Create self.routes list from database data.
 
-        Calls self.make_route for each GTFS route in the database."""
+        Calls self.make_route for each GTFS route in the database.
+        If self.jobs is more than 1, routes are split into chunks that are converted in parallel processes,
+        but not in more processes than there are CPUs - with only one, routes are converted in this process."""
+
+        with self._phase('get_routes') as phase:
+            jobs = min(self.jobs, available_cpus())
+            if jobs > 1:
+                self._get_routes_parallel(jobs)
+            else:
+                self._get_routes()
+            phase['rows'] = len(self.routes)
 
-        sql_routes, trips_by_route_id = self._get_routes_and_trips()
+    def _get_routes(self):
+        routes_and_trips = self._get_routes_and_trips()
 
         print("Converting routes...")
         self.routes = []
         self._route_sort_key_by_route_id = {}
-        for gtfs_route in sql_routes:
-            route = self.make_route(gtfs_route, trips_by_route_id[gtfs_route['route_id']])
-            self._route_sort_key_by_route_id[route['route_id']] = gtfs_route['sort_key']
+        for gtfs_route, gtfs_trips in routes_and_trips:
+            route = self.make_route(gtfs_route, gtfs_trips)
             if route.get('ref') and route.get('type'):
                 self.routes.append(route)
+                self._route_sort_key_by_route_id[route['route_id']] = (gtfs_route['sort_key'], self.sort_key(route))
             else:
                 print("Error: route without ref and type:")
                 print(route)
                 print(f"from: {dict(gtfs_route)}")
         print(f"Got {len(self.routes)} routes")
 
+    def _get_routes_parallel(self, jobs):
+        """Run get_routes for chunks of route_ids in a pool of jobs processes and collect the results into self.routes."""
+        query = f"""
+        SELECT route_id
+        FROM ({self._subquery(self._wrap_query(self.routes_query, self._route_conditions()))})
+        ORDER BY route_id
+        ;
+        """
+        route_ids = [row['route_id'] for row in self.get_cursor().execute(query)]
+        # one chunk for each process: each chunk connects and runs all the queries again,
+        # which costs more than the imbalance of chunks with the same number of routes
+        chunk_size = max(1, -(-len(route_ids) // jobs))
+        chunks = [route_ids[i:i + chunk_size] for i in range(0, len(route_ids), chunk_size)]
+
+        print(f"Converting {len(route_ids)} routes in {len(chunks)} chunks with {jobs} processes...")
+        self.routes = []
+        self._route_sort_key_by_route_id = {}
+        with ProcessPoolExecutor(jobs) as executor:
+            for chunk, (routes, route_sort_key_by_route_id, metrics, log) in enumerate(executor.map(_convert_routes_chunk, repeat(self), chunks, [True] + [False] * (len(chunks) - 1))):
+                # print the output of each chunk in order, as if they ran one after the other
+                print(log, end='')
+                self.routes += routes
+                self._route_sort_key_by_route_id.update(route_sort_key_by_route_id)
+                self.metrics += [{**phase, 'chunk': chunk} for phase in metrics]
+        print(f"Got {len(self.routes)} routes in total")
+
     def _get_routes_and_trips(self):
-        """Returns an iterable of routes, and - if required - a mapping from route_id to list of trips.
+        """Returns an iterable of (route, trips) pairs. The list of trips is empty unless trips are required.
 
         Determines whether trips and stops are required based on the defined route properties."""
-        sql_routes = self.get_sql_routes()
+        sql_routes = self._run_query_phase(self.get_sql_routes)
         sql_routes_columns = [c[0] for c in sql_routes.description]
 
         # We start by assuming we don't need trips or stops
@@ -268,30 +1229,56 @@ class PtnaRoutesImporter:
         trips_columns = None
         stops_cur = None
         stops_columns = None
+        # "from"/"to" only need the first and last stop of each trip, which is much cheaper to get
+        endpoint_fields = []
 
         print("Preparing required data based on route properties")
 
+        # remember where each field was found, for _get_route_values
+        self._field_tables = {}
+        self._pattern_trip_by_trip_id = None
+
+        if self._route_summary_usable(sql_routes_columns):
+            print("All route properties can be answered from ptna_route_summary - skipping trips and stops queries")
+            for field in self.route_summary_columns:
+                if isinstance(field, str) and field not in sql_routes_columns:
+                    self._field_tables[field] = 'trips'
+            summary_cur = self._run_query_phase(self.get_sql_route_summary)
+            with self._phase('get_route_summary', exclude_query_time=True) as phase:
+                summary_by_route_id = {row['route_id']: RouteSummary((key, json.loads(row[column] or '[]')) for key, column in self.route_summary_columns.items())
+                    for row in summary_cur}
+                phase['rows'] = len(summary_by_route_id)
+            return ((gtfs_route, summary_by_route_id.get(gtfs_route['route_id'], RouteSummary())) for gtfs_route in sql_routes)
+
         for prop_name, source in self.route_properties.items():
             if isinstance(source, str):
                 # source is SQL column(s)
                 print(f"{prop_name} = {source}")
-                for field in self.split_source(source)[0]:
+                for field in self._parse_source(source)[0]:
                     if field in sql_routes_columns:
                         print(f"\t{field} found in routes query")
+                        self._field_tables[field] = 'routes'
                         continue
 
                     # not a route column, we need trips
-                    trips_cur = trips_cur or self.get_sql_trips()
+                    trips_cur = trips_cur or self._run_query_phase(self.get_sql_trips)
                     trips_columns = trips_columns or [c[0] for c in trips_cur.description]
                     if field in trips_columns:
                         print(f"\t{field} found in trips query")
+                        self._field_tables[field] = 'trips'
+                        continue
+
+                    if prop_name in ['from', 'to'] and field == 'stop_name':
+                        # decide later whether all stops are needed anyway
+                        endpoint_fields.append((prop_name, field))
                         continue
 
                     # not a trip column, we need stops
-                    stops_cur = stops_cur or self.get_sql_stop_times()
+                    stops_cur = stops_cur or self._run_stop_times_query_phase()
                     stops_columns = stops_columns or [c[0] for c in stops_cur.description]
                     if field in stops_columns:
                         print(f"\t{field} found in stop_times/stops query")
+                        self._field_tables[field] = 'stops'
                         continue
 
                     raise RuntimeError(f"Column {field!r} for route property {prop_name!r} could not be found in any of the SQL queries. "
@@ -303,31 +1290,85 @@ class PtnaRoutesImporter:
                 print(f"{prop_name} = {f}, {'with' if get_trips else 'without'} trips and {'with' if get_stops else 'does not require' if get_trips else 'without'} stops")
                 assert get_trips or not get_stops # can't get stops without trips, should have raised an error before reaching here
                 if get_trips:
-                    trips_cur = trips_cur or self.get_sql_trips()
+                    trips_cur = trips_cur or self._run_query_phase(self.get_sql_trips)
                 if get_stops:
-                    stops_cur = stops_cur or self.get_sql_stop_times()
+                    stops_cur = stops_cur or self._run_stop_times_query_phase()
+
+        if endpoint_fields:
+            if not stops_cur:
+                print("Only first and last stops are required")
+                stops_cur = self._run_query_phase(self.get_sql_trip_endpoints)
+            stops_columns = stops_columns or [c[0] for c in stops_cur.description]
+            for prop_name, field in endpoint_fields:
+                if field not in stops_columns:
+                    raise RuntimeError(f"Column {field!r} for route property {prop_name!r} could not be found in any of the SQL queries. "
+                        "The available columns for routes, trips, and stops respectively:",
+                        sql_routes_columns, trips_columns, stops_columns)
+                print(f"\t{field} for {prop_name} found in stop_times/stops query")
+                self._field_tables[field] = 'stops'
+
+        if self.streaming:
+            return self._merge_routes_and_trips(sql_routes, self.iter_trips_by_route_id(trips_cur, stops_cur))
+
+        with self._phase('get_trips', exclude_query_time=True) as phase:
+            trips_by_route_id = self.get_trips(trips_cur, stops_cur)
+            phase['rows'] = self._count_rows(trips_by_route_id)
+        return ((gtfs_route, trips_by_route_id[gtfs_route['route_id']]) for gtfs_route in sql_routes)
+
+    @staticmethod
+    def _count_rows(trips_by_route_id):
+        """Number of trips and stop_times in the return value of get_trips"""
+        rows = 0
+        for trips in trips_by_route_id.values():
+            rows += len(trips)
+            if 'stops' in trips.trip_columns:
+                stops_index = trips.trip_columns['stops']
+                rows += sum(len(trip[stops_index]) for trip in trips)
+        return rows
 
-        trips_by_route_id = self.get_trips(trips_cur, stops_cur)
-        return sql_routes, trips_by_route_id
+    @staticmethod
+    def _merge_routes_and_trips(sql_routes, trips_by_route_id):
+        """Pair each route with its trips, given both iterables ordered by route_id.
+
+        Trips whose route_id is not in the routes are skipped, like they are when not streaming."""
+        route_id, trips = next(trips_by_route_id, (None, None))
+        for gtfs_route in sql_routes:
+            while route_id is not None and route_id < gtfs_route['route_id']:
+                route_id, trips = next(trips_by_route_id, (None, None))
+            if route_id == gtfs_route['route_id']:
+                yield gtfs_route, trips
+            else:
+                yield gtfs_route, []
+        # finish the trips, which reports their phase (see iter_trips_by_route_id)
+        for _ in trips_by_route_id:
+            pass
 
     def get_trips(self, trips_cur, stops_cur):
         """Get trips from the database.
 
-        Return value is a dict where the key is route_id and the value is a list of trip mappings.
-        Trip mappings are sqlite3.Row if they do not include stops, or dict if they do.
-        If they include stops, they have a new key called 'stops' which contains a list of sqlite3.Row objects
-        with the fields from stop_times_query
+        Return value is a dict where the key is route_id and the value is a TripRecords list of compact trip records.
+        If stops are included, each trip record ends with a list of stop records with the fields from stop_times_query.
+        If stops are only required for "from" and "to", stops_cur comes from get_sql_trip_endpoints
+        and the stops list only has the first and last stop of the trip.
+        Trips with the same stops may share one list (see _stop_patterns_usable).
+        Property functions get these trips as views (see TripRecords.views): sqlite3.Row-like if they do not include stops,
+        or dict-like with a 'stops' key if they do.
         """
-        trips_by_route_id = defaultdict(list)
-
         if not trips_cur:
             # no action needed
             print("Skipping trips and stops queries - not required")
-            return trips_by_route_id
+            return defaultdict(list)
+
+        trip_columns = _columns_index(trips_cur)
+        stop_columns = _columns_index(stops_cur) if stops_cur else None
+        if stops_cur:
+            trip_columns['stops'] = len(trips_cur.description)
+        trips_by_route_id = defaultdict(lambda: TripRecords(trip_columns, stop_columns))
+        route_id_index = trip_columns['route_id']
 
         print("Getting trip data from query...")
         for trip in trips_cur:
-            trips_by_route_id[trip['route_id']].append(trip)
+            trips_by_route_id[trip[route_id_index]].append(trip)
 
         print(f"Got {sum(len(ts) for ts in trips_by_route_id.values())} trips for {len(trips_by_route_id)} route_ids")
 
@@ -338,27 +1379,118 @@ class PtnaRoutesImporter:
 
         # get stops for each trip
         print("Getting stop_time/stop data from query...")
+        stop_trip_id_index = stop_columns['trip_id']
+        stop_sequence_index = stop_columns['stop_sequence']
         stops_by_trip_id = defaultdict(dict)
         for stop in stops_cur:
-            trip_seq_dict = stops_by_trip_id[stop['trip_id']]
-            trip_seq_dict[int(stop['stop_sequence'])] = stop
+            trip_seq_dict = stops_by_trip_id[stop[stop_trip_id_index]]
+            trip_seq_dict[int(stop[stop_sequence_index])] = stop
 
         print(f"Got {sum(len(ss) for ss in stops_by_trip_id.values())} stop_times for {len(stops_by_trip_id)} trip_ids")
 
         # give each trip its stops list
+        trip_id_index = trip_columns['trip_id']
+        pattern_trip_by_trip_id = self._pattern_trip_by_trip_id
+        if pattern_trip_by_trip_id is not None:
+            # stops were only read for one trip of each stop pattern, which shares its list with the other trips
+            stops_by_pattern_trip_id = {trip_id: [trip_stops[j] for j in sorted(trip_stops.keys())] for trip_id, trip_stops in stops_by_trip_id.items()}
+            stops_by_trip_id = None
         for trips in trips_by_route_id.values():
             for i, trip in enumerate(trips):
-                trip = dict(trip) # convert sqlite3.Row to dict
-                trips[i] = trip # replace Row with new dict
-                trip_id = trip['trip_id']
-                trip_stops = stops_by_trip_id[trip_id]
-                trip['stops'] = [trip_stops[j] for j in sorted(trip_stops.keys())]
+                if pattern_trip_by_trip_id is not None:
+                    trip_stops = stops_by_pattern_trip_id.get(pattern_trip_by_trip_id.get(trip[trip_id_index]), [])
+                else:
+                    trip_stops = stops_by_trip_id.pop(trip[trip_id_index], {})
+                    trip_stops = [trip_stops[j] for j in sorted(trip_stops.keys())]
+                # replace the record with one that has the stops at the end
+                trips[i] = (*trip, trip_stops)
         return trips_by_route_id
 
+    def iter_trips_by_route_id(self, trips_cur, stops_cur):
+        """Streaming version of get_trips, used when self.streaming is True.
+
+        Yields (route_id, trips) one route at a time, ordered by route_id, so that only a single route's
+        trips and stops are held in memory. Trips are the same as the values returned by get_trips.
+        Requires trips_cur to be ordered by route_id, trip_id, and stops_cur to be in the same order of trips,
+        as done by get_sql_trips and get_sql_stop_times in streaming mode.
+        """
+        if not trips_cur:
+            print("Skipping trips and stops queries - not required")
+            return
+
+        if not stops_cur:
+            print("Skipping stops query - not required")
+
+        trip_columns = _columns_index(trips_cur)
+        stop_columns = _columns_index(stops_cur) if stops_cur else None
+        if stops_cur:
+            trip_columns['stops'] = len(trips_cur.description)
+            stop_trip_id_index = stop_columns['trip_id']
+            stop_sequence_index = stop_columns['stop_sequence']
+        trip_id_index = trip_columns['trip_id']
+
+        print("Streaming trip and stop_time/stop data from queries...")
+        # the time spent here is measured as the get_trips phase, not including the time between routes
+        # and the time spent fetching query rows (see QueryRows)
+        elapsed = 0
+        start = time.perf_counter()
+        query_time = self._query_time
+        stops_iter = iter(stops_cur or ())
+        stop = next(stops_iter, None)
+        trip_count = 0
+        stop_time_count = 0
+        route_count = 0
+        for route_id, route_trips in groupby(trips_cur, key=itemgetter(trip_columns['route_id'])):
+            trips = TripRecords(trip_columns, stop_columns)
+            for trip in route_trips:
+                if stops_cur:
+                    trip_stops = {}
+                    # stops of a trip are consecutive, and ordered like the trips
+                    while stop is not None and stop[stop_trip_id_index] == trip[trip_id_index]:
+                        trip_stops[int(stop[stop_sequence_index])] = stop
+                        stop_time_count += 1
+                        stop = next(stops_iter, None)
+                    trip = (*trip, [trip_stops[j] for j in sorted(trip_stops.keys())])
+                trips.append(trip)
+            trip_count += len(trips)
+            route_count += 1
+            elapsed += time.perf_counter() - start - (self._query_time - query_time)
+            yield route_id, trips
+            start = time.perf_counter()
+            query_time = self._query_time
+
+        elapsed += time.perf_counter() - start - (self._query_time - query_time)
+        self._phase_done('get_trips', elapsed, trip_count + stop_time_count)
+        print(f"Streamed {trip_count} trips for {route_count} route_ids" + (f" with {stop_time_count} stop_times" if stops_cur else ""))
+
     def sort_routes(self):
-        """Sort self.routes."""
+        """Sort self.routes.
+
+        The sort keys are made once for each route by get_routes (see _route_sort_key_by_route_id). Routes are grouped by
+        type_sort_key, and the routes of each type are sorted by sort_key on their own, which gives the same order as
+        sorting all routes by _make_sort_key.
+        """
         print("Sorting routes")
-        self.routes.sort(key=self._make_sort_key())
+        with self._phase('sort_routes') as phase:
+            sort_keys = self._route_sort_key_by_route_id
+            routes_by_type = defaultdict(list)
+            for route in self.routes:
+                routes_by_type[sort_keys[route['route_id']][0]].append(route)
+            self.routes = []
+            for type_sort_key in sorted(routes_by_type):
+                self.routes += sorted(routes_by_type[type_sort_key], key=lambda route: sort_keys[route['route_id']][1])
+            phase['rows'] = len(self.routes)
+
+    def merge_routes(self, previous_routes):
+        """Merge routes of a previous catalog, in their sorted order, into the sorted self.routes (see main_incremental)"""
+        print(f"Merging {len(previous_routes)} routes from the previous catalog")
+        with self._phase('merge_routes') as phase:
+            cur = self.get_cursor()
+            type_sort_key_by_route_id = {row['route_id']: row['sort_key'] for row in cur.execute(f"SELECT route_id, sort_key FROM ({self._subquery(self.routes_query)});")}
+            for route in previous_routes:
+                self._route_sort_key_by_route_id[route['route_id']] = (type_sort_key_by_route_id[route['route_id']], self.sort_key(route))
+            self.routes = list(heapq.merge(previous_routes, self.routes, key=self._make_sort_key()))
+            phase['rows'] = len(self.routes)
 
     @staticmethod
     def sort_key(route):
@@ -372,27 +1504,17 @@ class PtnaRoutesImporter:
         This key is only used to decide the order of routes with the same type.
         Generally, routes of different types would never be put in the same import statement anyway.
         """
-        # separate numbers and non-numbers in ref
-        # examples:
-        # "532" -> ['', '532', '']
-        # "A" -> ['A']
-        # "T53-E2" -> ['T', '53', '-E', '2', '']
-        # "2B" -> ['', '2', 'B']
-        split_ref = re.split(r'(\d+)', route['ref'])
-        # convert number strings to numbers
-        # example:
-        # ['T', '53', '-E', '2', ''] -> ['T', 53, '-E', 2, '']
-        split_ref[1::2] = [int(x) for x in split_ref[1::2]]
-
-        return (split_ref, route['ref'], route.get('operator'), route['route_id'])
+        # numbers in ref are compared by value, see natural_sort_key
+        return (natural_sort_key(route['ref']), route['ref'], route.get('operator'), route['route_id'])
         # route['ref'] is used to be consistent between 003, 03 and 3
 
     def _make_sort_key(self):
         """Prepend type_sort_key to the sort key returned by sort_key.
 
         Do not override this method! Override sort_key instead.
+        The keys are made once for each route, by get_routes, and looked up here.
         """
-        return lambda route: (self._route_sort_key_by_route_id[route['route_id']], self.sort_key(route))
+        return lambda route: self._route_sort_key_by_route_id[route['route_id']]
 
     def make_route(self, gtfs_route, gtfs_trips=[]):
         """Convert a GTFS route to a CSV route.
@@ -400,14 +1522,18 @@ class PtnaRoutesImporter:
         Do not override this method - instead configure its behaviour using set_route_property
         Arguments:
         gtfs_route -- sqlite3.Row for the GTFS route
-        gtfs_trips -- (optional) list of trips (each being sqlite3.Row (though this might change to dict)) that belong to this route
+        gtfs_trips -- (optional) list of trips that belong to this route - either TripRecords as returned by get_trips,
+            or trip mappings (sqlite3.Row or dict), or a RouteSummary
 
         Return value:
         dict representing this route as it should appear in the output JSON.
         """
         route = {}
+        route_values = self._get_route_values(gtfs_route, gtfs_trips)
+        # property functions get views, not compact records
+        trip_views = gtfs_trips.views() if isinstance(gtfs_trips, TripRecords) and self._functions_get_trips() else None
         for property_name, source in self.route_properties.items():
-            route[property_name] = self._get_property(gtfs_route, gtfs_trips, property_name, source)
+            route[property_name] = self._get_property(gtfs_route, gtfs_trips, property_name, source, route_values, trip_views)
 
         # delete None/empty values
         for k in list(route.keys()):
@@ -415,10 +1541,154 @@ class PtnaRoutesImporter:
                 del route[k]
         return route
 
-    def output_routes(self, out_file):
+    def _functions_get_trips(self):
+        """Whether any route property is a function that gets trips"""
+        return any(not isinstance(source, str) and source[1] for source in self.route_properties.values())
+
+    def _functions_get_stops(self):
+        """Whether any route property is a function that gets stops"""
+        return any(not isinstance(source, str) and source[2] for source in self.route_properties.values())
+
+    def get_route_hashes(self, con):
+        """Hash the rows of each route that the route properties can see, in the database connection con.
+
+        Returns a dict mapping route_id to a hex digest, which changes when anything that make_route can see changes.
+        The rows of the routes query are always hashed. Trips and stops are only hashed when the route properties need them,
+        like _get_routes_and_trips reads them: the ptna_route_summary rows if it can answer the properties (see _route_summary_usable),
+        otherwise the rows of the trips query, and of the stop_times query - or only the first and last stops, if stops are
+        only needed for "from" and "to".
+        Rows are hashed in the order of the queries, so a route whose rows only moved around is seen as changed too,
+        which costs converting it again but is never wrong. Data that property functions get from elsewhere is not included.
+        With set_active_dates, only the active trips are hashed, so routes whose active trips changed are converted again.
+        """
+        print("Hashing the rows of each route")
+        with self._phase('get_route_hashes') as phase:
+            cur = con.cursor()
+            cur.row_factory = None
+            hashes = {}
+            hash_by_trip_id = {}
+            columns = []
+            rows = 0
+
+            cur.execute(self._wrap_query(self.routes_query, self._active_route_conditions()))
+            columns.append(_columns_index(cur))
+            routes_columns = columns[-1]
+            route_id_index = routes_columns['route_id']
+            for row in cur:
+                hashes[row[route_id_index]] = hashlib.sha256(repr(row).encode())
+                rows += 1
+
+            # the fields that aren't route columns, which need trips or stops
+            fields = [(property_name, field) for property_name, source in self.route_properties.items() if isinstance(source, str)
+                for field in self._parse_source(source)[0] if field not in routes_columns]
+            if not fields and not self._functions_get_trips():
+                stops_query = None
+            elif self._route_summary_usable(list(routes_columns), con):
+                # the summary has everything the route properties need from trips and stops
+                stops_query = None
+                cur.execute("SELECT * FROM main.ptna_route_summary;")
+                columns.append(_columns_index(cur))
+                route_id_index = columns[-1]['route_id']
+                for row in cur:
+                    route_hash = hashes.get(row[route_id_index])
+                    if route_hash:
+                        route_hash.update(repr(row).encode())
+                    rows += 1
+            else:
+                cur.execute(self._wrap_query(self.trips_query, self._active_trip_conditions()))
+                columns.append(_columns_index(cur))
+                trips_columns = columns[-1]
+                route_id_index = trips_columns['route_id']
+                trip_id_index = trips_columns['trip_id']
+                for row in cur:
+                    route_hash = hashes.get(row[route_id_index])
+                    if route_hash:
+                        hash_by_trip_id[row[trip_id_index]] = route_hash
+                        route_hash.update(repr(row).encode())
+                    rows += 1
+
+                stop_fields = [(property_name, field) for property_name, field in fields if field not in trips_columns]
+                if self._functions_get_stops() or any(property_name not in ('from', 'to') or field != 'stop_name' for property_name, field in stop_fields):
+                    stops_query = self.stop_times_query
+                elif stop_fields:
+                    stops_query = self._stop_times_query(endpoints_only=True)
+                else:
+                    stops_query = None
+
+            if stops_query:
+                cur.execute(stops_query)
+                columns.append(_columns_index(cur))
+                trip_id_index = columns[-1]['trip_id']
+                for row in cur:
+                    route_hash = hash_by_trip_id.get(row[trip_id_index])
+                    if route_hash:
+                        route_hash.update(repr(row).encode())
+                    rows += 1
+
+            # the columns are part of the hash, so the hashes of databases with different columns,
+            # or of different parts of the database, never match
+            columns = repr([list(c) for c in columns]).encode()
+            for route_id, route_hash in hashes.items():
+                route_hash.update(columns)
+                hashes[route_id] = route_hash.hexdigest()
+            phase['rows'] = rows
+        return hashes
+
+    @staticmethod
+    def route_hashes_file(catalog_file):
+        """The file with the route hashes of a catalog, written by main_incremental, and by main if asked to"""
+        return f"{catalog_file}.route-hashes.json"
+
+    def _route_hashes_config(self):
+        """Everything besides the database that the routes in a catalog depend on, for the route hashes file"""
+        properties = {name: source if isinstance(source, str) else [getattr(source[0], '__qualname__', repr(source[0])), source[1], source[2]]
+            for name, source in self.route_properties.items()}
+        return {
+            'gtfs_feed': self.gtfs_feed,
+            'properties': properties,
+            'queries': [self.routes_query, self.trips_query, self.stop_times_query],
+        }
+
+    def read_route_hashes(self, catalog_file):
+        """Read the route hashes file of catalog_file. Returns (config, route_hashes), or (None, None) if there is no such file."""
+        hashes_file = self.route_hashes_file(catalog_file)
+        if not os.path.exists(hashes_file):
+            return None, None
+        print(f"Reading route hashes from {hashes_file}")
+        with open(hashes_file, encoding='utf-8') as f:
+            route_hashes = json.load(f)
+        return route_hashes['config'], route_hashes['routes']
+
+    def write_route_hashes(self, catalog_file, route_hashes):
+        hashes_file = self.route_hashes_file(catalog_file)
+        print(f"Writing route hashes to {hashes_file}")
+        tmp_file = f"{hashes_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'config': self._route_hashes_config(), 'routes': route_hashes}, f, ensure_ascii=False)
+        os.replace(tmp_file, hashes_file)
+
+    def output_routes(self, out_file, ndjson=False):
         print(f"Writing routes to {out_file}")
-        with open(out_file, 'w', encoding='utf-8') as f:
-            json.dump(self.routes, f, ensure_ascii=False)
+        with self._phase('output_routes') as phase:
+            phase['rows'] = write_routes(self.routes, out_file, ndjson)
+
+
+def _convert_routes_chunk(importer, route_ids, first_chunk):
+    """Process pool worker for PtnaRoutesImporter._get_routes_parallel
+
+    importer is a pickled copy of the importer, which gets its own read-only connection.
+    Query plans are only reported for the first chunk, the queries of the other chunks only differ in their route_ids.
+    Returns the converted routes, their sort keys, metrics of the phases, and everything that was printed.
+    """
+    log = io.StringIO()
+    with redirect_stdout(log):
+        importer.jobs = 1
+        importer.metrics = []
+        importer.report_query_plans = importer.report_query_plans and first_chunk
+        importer._connect()
+        importer.select_route_ids(route_ids)
+        importer.get_routes()
+    return importer.routes, importer._route_sort_key_by_route_id, importer.metrics, log.getvalue()
 
 
 # Commandline script
@@ -434,11 +1704,36 @@ def main():
     parser.add_argument('-d', '--database', required=True, help='sqlite3 database file created by PTNA')
     parser.add_argument('-g', '--gtfs-feed', required=True, help='feed identifier - value for gtfs_feed')
     parser.add_argument('-o', '--outfile', required=True, help='routes output file (.json)')
+    parser.add_argument('--ndjson', action='store_true', help='write one route per line (newline-delimited JSON) instead of a JSON array')
+    parser.add_argument('--streaming', action='store_true', help='process one route at a time to reduce memory usage on large feeds')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes for converting routes, at most the number of CPUs (default: 1)')
+    parser.add_argument('--index-database', metavar='FILE', help='side database for indexed copies of large tables, created if needed - the database itself is not changed')
+    parser.add_argument('--query-plans', action='store_true', help='print the slow parts of the query plans: full table scans and temp B-trees for sorting')
+    parser.add_argument('--no-route-summary', action='store_true', help='always read trips and stop_times, even if the ptna_route_summary table can answer the route properties')
+    parser.add_argument('--no-stop-patterns', action='store_true', help='read the stop_times of every trip, instead of one trip of each stop pattern')
+    parser.add_argument('--metrics', metavar='FILE', help='write timing and memory metrics of each phase to this file (.json)')
+    parser.add_argument('--previous-catalog', metavar='FILE', help='routes output file of the previous release - only new and changed routes are converted, the rest are copied from it')
+    parser.add_argument('--route-hashes', action='store_true', help='also write the route hashes file next to the routes output file, for --previous-catalog of the next release - always done with --previous-catalog')
+    active = parser.add_mutually_exclusive_group()
+    active.add_argument('--active-on', metavar='DATE', type=date.fromisoformat, help='only use trips that run on this date (YYYY-MM-DD), according to calendar and calendar_dates')
+    active.add_argument('--active-between', metavar=('FIRST', 'LAST'), nargs=2, type=date.fromisoformat, help='only use trips that run on at least one day from FIRST to LAST (YYYY-MM-DD, inclusive)')
     parser.add_argument("properties", metavar='property=sql-column', nargs="*", action=PropertyParseAction, help="output route property and its associated source column, see example")
 
     args = parser.parse_args()
 
-    importer = PtnaRoutesImporter(args.gtfs_feed, args.database)
+    importer = PtnaRoutesImporter(args.gtfs_feed, args.database, streaming=args.streaming, jobs=args.jobs)
+    if args.index_database:
+        importer.use_index_database(args.index_database)
+    if args.query_plans:
+        importer.report_query_plans = True
+    if args.no_route_summary:
+        importer.use_route_summary = False
+    if args.no_stop_patterns:
+        importer.share_stop_patterns = False
+    if args.active_on:
+        importer.set_active_dates(args.active_on, args.active_on)
+    elif args.active_between:
+        importer.set_active_dates(*args.active_between)
 
     for prop, source in args.properties.items():
         if source:
@@ -446,7 +1741,13 @@ def main():
         else:
             importer.remove_route_property(prop)
 
-    importer.main(args.outfile)
+    if args.previous_catalog:
+        importer.main_incremental(args.outfile, args.previous_catalog, args.ndjson)
+    else:
+        importer.main(args.outfile, args.ndjson, args.route_hashes)
+
+    if args.metrics:
+        importer.write_metrics(args.metrics)
 
 if __name__ == "__main__":
     main()
@@ -94,6 +94,12 @@ then
 fi
 
 
+echo "$(date '+%Y-%m-%d %H:%M:%S') start route summary $*"
+gtfs-summarize-ptna-sqlite.sh
+ret_code=$?
+error_code=$(( $error_code + $ret_code ))
+
+
 if [ -f ../post-analysis.sh ]
 then
     echo "$(date '+%Y-%m-%d %H:%M:%S') start post analysis $*"
@@ -0,0 +1,118 @@
+#!/bin/bash
+
+#
+# create a TABLE with a summary of the trips and stops of each route, as needed for the catalog of genericGtfsImport.py
+#
+# this runs after aggregation and normalization, because these change the trips and stop_times tables
+# genericGtfsImport.py uses the table instead of reading all trips and stop_times, as long as 'ptna_route_summary_source'
+# says it's up to date: the TRIGGERs below mark it stale on any change of the routes, trips, stops and stop_times tables,
+# and it keeps the dates of the 'ptna' table, which change when the steps above run again
+#
+# the distinct values are stored as JSON arrays
+#
+
+DB="ptna-gtfs-sqlite.db"
+
+SQ_OPTIONS="-init /dev/null -batch -echo -csv -header"
+SQ_OPTIONS_PURE="-init /dev/null -csv -batch -noheader"
+
+if [ ! -f "$DB" ]
+then
+    echo "$DB not found"
+    exit 1
+fi
+
+
+echo
+echo "Table 'ptna_route_summary'"
+
+sqlite3 $SQ_OPTIONS "$DB" "DROP TABLE IF EXISTS ptna_route_summary;"
+sqlite3 $SQ_OPTIONS "$DB" "DROP TABLE IF EXISTS ptna_route_summary_source;"
+for table in routes trips stops stop_times
+do
+    for action in insert update delete
+    do
+        sqlite3 $SQ_OPTIONS "$DB" "DROP TRIGGER IF EXISTS ptna_route_summary_${table}_${action};"
+    done
+done
+
+if [ "$(sqlite3 $SQ_OPTIONS_PURE "$DB" "SELECT COUNT(*) FROM pragma_table_info('trips') WHERE name IN ('trip_headsign','direction_id');")" != 2 ]
+then
+    echo "trips without trip_headsign or direction_id - no summary"
+    exit 0
+fi
+
+# the first and last stop of each trip, like genericGtfsImport.py gets them from 'stop_times LEFT NATURAL JOIN stops'
+sqlite3 $SQ_OPTIONS "$DB" "
+CREATE TEMP TABLE trip_endpoints AS
+    SELECT trip_id, MIN(CAST(stop_sequence AS INTEGER)) AS first_stop_sequence, MAX(CAST(stop_sequence AS INTEGER)) AS last_stop_sequence
+    FROM stop_times
+    GROUP BY trip_id;
+CREATE TEMP TABLE trip_endpoint_names AS
+    SELECT trips.route_id AS route_id, 'from' AS endpoint, stops.stop_name AS stop_name
+    FROM stop_times
+    LEFT NATURAL JOIN stops
+    JOIN trip_endpoints ON trip_endpoints.trip_id = stop_times.trip_id
+    JOIN trips ON trips.trip_id = stop_times.trip_id
+    WHERE CAST(stop_times.stop_sequence AS INTEGER) = trip_endpoints.first_stop_sequence
+    UNION
+    SELECT trips.route_id, 'to', stops.stop_name
+    FROM stop_times
+    LEFT NATURAL JOIN stops
+    JOIN trip_endpoints ON trip_endpoints.trip_id = stop_times.trip_id
+    JOIN trips ON trips.trip_id = stop_times.trip_id
+    WHERE CAST(stop_times.stop_sequence AS INTEGER) = trip_endpoints.last_stop_sequence;
+CREATE INDEX temp.idx_trip_endpoint_names ON trip_endpoint_names (route_id, endpoint);
+CREATE TABLE ptna_route_summary (route_id TEXT DEFAULT '' PRIMARY KEY UNIQUE, trip_count INTEGER DEFAULT 0, trip_headsign TEXT DEFAULT '[]', direction_id TEXT DEFAULT '[]', from_trip_headsign TEXT DEFAULT '[]', to_trip_headsign TEXT DEFAULT '[]', from_stop_name TEXT DEFAULT '[]', to_stop_name TEXT DEFAULT '[]');
+INSERT INTO ptna_route_summary
+    SELECT route_id,
+           (SELECT COUNT(*) FROM trips WHERE trips.route_id = routes.route_id),
+           (SELECT json_group_array(trip_headsign) FROM (SELECT DISTINCT trip_headsign FROM trips WHERE trips.route_id = routes.route_id)),
+           (SELECT json_group_array(direction_id)  FROM (SELECT DISTINCT direction_id  FROM trips WHERE trips.route_id = routes.route_id)),
+           (SELECT json_group_array(trip_headsign) FROM (SELECT DISTINCT trip_headsign FROM trips WHERE trips.route_id = routes.route_id AND direction_id = '1')),
+           (SELECT json_group_array(trip_headsign) FROM (SELECT DISTINCT trip_headsign FROM trips WHERE trips.route_id = routes.route_id AND direction_id = '0')),
+           (SELECT json_group_array(stop_name) FROM (SELECT DISTINCT stop_name FROM trip_endpoint_names WHERE trip_endpoint_names.route_id = routes.route_id AND endpoint = 'from')),
+           (SELECT json_group_array(stop_name) FROM (SELECT DISTINCT stop_name FROM trip_endpoint_names WHERE trip_endpoint_names.route_id = routes.route_id AND endpoint = 'to'))
+    FROM routes;
+CREATE TABLE ptna_route_summary_source (stale INTEGER DEFAULT 0, prepared TEXT DEFAULT '', aggregated TEXT DEFAULT '', analyzed TEXT DEFAULT '', normalized TEXT DEFAULT '', release_date TEXT DEFAULT '');
+INSERT INTO ptna_route_summary_source (stale) VALUES (0);
+"
+ret_code=$?
+
+if [ $ret_code -eq 0 -a "$(sqlite3 $SQ_OPTIONS_PURE "$DB" "SELECT COUNT(*) FROM ptna WHERE id=1;" 2> /dev/null)" = 1 ]
+then
+    sqlite3 $SQ_OPTIONS "$DB" "UPDATE ptna_route_summary_source SET (prepared,aggregated,analyzed,normalized,release_date) = (SELECT prepared,aggregated,analyzed,normalized,release_date FROM ptna WHERE id=1);"
+    ret_code=$?
+fi
+
+# only the first change of a table writes to 'ptna_route_summary_source', the later ones don't match 'stale=0' any more
+for table in routes trips stops stop_times
+do
+    for action in insert update delete
+    do
+        if [ $ret_code -eq 0 ]
+        then
+            sqlite3 $SQ_OPTIONS "$DB" "CREATE TRIGGER ptna_route_summary_${table}_${action} AFTER ${action^^} ON $table BEGIN UPDATE ptna_route_summary_source SET stale=1 WHERE stale=0; END;"
+            ret_code=$?
+        fi
+    done
+done
+
+if [ $ret_code -ne 0 ]
+then
+    sqlite3 $SQ_OPTIONS "$DB" "DROP TABLE IF EXISTS ptna_route_summary;"
+    sqlite3 $SQ_OPTIONS "$DB" "DROP TABLE IF EXISTS ptna_route_summary_source;"
+    for table in routes trips stops stop_times
+    do
+        for action in insert update delete
+        do
+            sqlite3 $SQ_OPTIONS "$DB" "DROP TRIGGER IF EXISTS ptna_route_summary_${table}_${action};"
+        done
+    done
+    exit $ret_code
+fi
+
+echo
+echo "Test for ptna_route_summary"
+sqlite3 $SQ_OPTIONS "$DB" "SELECT * FROM ptna_route_summary LIMIT 2;" | tr -c '\0-\177' '[?*]'
+sqlite3 $SQ_OPTIONS "$DB" "SELECT * FROM ptna_route_summary_source;"
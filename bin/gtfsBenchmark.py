@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Copyright 2025 Nitai Sasson
+# Licensed under GNU GPLv3 or later
+
+# Benchmark for the Python tools in this directory.
+# Generates a synthetic GTFS feed (Israel-style, so that israelGtfsRoutesInShape.py can read it too),
+# loads it into a PTNA-style sqlite database like gtfs-prepare-ptna-sqlite.sh does,
+# then runs genericGtfsImport.py and israelGtfsRoutesInShape.py on it with various options,
+# each in a separate process so that peak memory can be measured.
+# Results are written as JSON so that runs can be compared.
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from os import path
+
+bin_dir = path.dirname(path.abspath(__file__))
+
+scales = {
+    '1k': dict(routes=1000, trips_per_route=10, stops_per_trip=20),
+    '10k': dict(routes=10000, trips_per_route=20, stops_per_trip=25),
+    '100k': dict(routes=100000, trips_per_route=20, stops_per_trip=25), # 50M stop_times
+}
+"""Preset feed sizes for --scale"""
+
+generic_scenarios = {
+    'routes-only': dict(properties={}),
+    'post-analysis': dict(properties={'comment': 'route_long_name', 'from': 'trip_headsign|stop_name', 'to': 'trip_headsign|stop_name'}),
+    'post-analysis-streaming': dict(properties={'comment': 'route_long_name', 'from': 'trip_headsign|stop_name', 'to': 'trip_headsign|stop_name'}, streaming=True),
+    'post-analysis-jobs': dict(properties={'comment': 'route_long_name', 'from': 'trip_headsign|stop_name', 'to': 'trip_headsign|stop_name'}, jobs=os.cpu_count() or 1),
+    'all-stops': dict(properties={'comment': 'route_long_name', 'from': 'trip_headsign|stop_name', 'to': 'trip_headsign|stop_name', 'stops': 'stop_name'}),
+}
+"""Keyword arguments for PtnaRoutesImporter and its route properties"""
+
+israel_scenarios = {
+    'shape': dict(trains=False),
+    'trains': dict(trains=True),
+    'shape-database': dict(trains=False, database=True),
+    'trains-database': dict(trains=True, database=True),
+}
+"""Modes of israelGtfsRoutesInShape.main"""
+
+### Synthetic feed ###
+cities = ['ירושלים', 'תל אביב יפו', 'חיפה', 'באר שבע', 'נתניה', 'אשדוד', 'ראשון לציון', 'פתח תקווה', 'חולון', 'בני ברק',
+    'רמת גן', 'אשקלון', 'רחובות', 'בת ים', 'כפר סבא', 'הרצליה', 'חדרה', 'מודיעין', 'נצרת', 'לוד', 'רמלה', 'עכו', 'אילת', 'טבריה']
+streets = ['הרצל', 'ז\'בוטינסקי', 'בן גוריון', 'ויצמן', 'רוטשילד', 'הנשיא', 'יפו', 'העצמאות', 'סוקולוב', 'ביאליק', "רש''י", 'אחד העם']
+
+# roughly the bounding box of Israel
+min_lat, max_lat = 29.5, 33.3
+min_lon, max_lon = 34.3, 35.9
+
+def generate_feed(gtfs_dir, routes, trips_per_route, stops_per_trip, seed=1):
+    """Write a synthetic GTFS feed to gtfs_dir and return the number of rows in each file.
+
+    Bus routes come in pairs (both directions) with Israel-style route_desc (catalog number-direction-alternative),
+    stops have Israel-style stop_desc with the city, and there are train lines whose trip_headsign is the train number.
+    """
+    rng = random.Random(seed)
+    os.makedirs(gtfs_dir, exist_ok=True)
+    counts = {}
+
+    def writer(name, header):
+        f = open(path.join(gtfs_dir, name), 'w', newline='', encoding='utf-8')
+        w = csv.writer(f)
+        w.writerow(header)
+        return f, w
+
+    # stops: bus stops spread over the country, plus train stations
+    stop_count = max(100, routes * 2)
+    station_count = 60
+    f, w = writer('stops.txt', ['stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon', 'location_type', 'parent_station', 'zone_id'])
+    for i in range(stop_count):
+        lat = rng.uniform(min_lat, max_lat)
+        lon = rng.uniform(min_lon, max_lon)
+        city = cities[int((lat - min_lat) / (max_lat - min_lat) * len(cities)) % len(cities)]
+        street = rng.choice(streets)
+        name = f"{street}/{rng.choice(streets)}" if i % 3 else f"{street} {i % 97}\xa0"
+        w.writerow([str(i + 1), str(10000 + i), name, f"רחוב: {street} {i % 50} עיר: {city} רציף:   קומה:  ", f"{lat:.6f}", f"{lon:.6f}", '0', '', str(i % 30)])
+    for i in range(station_count):
+        lat = min_lat + (max_lat - min_lat) * i / station_count
+        w.writerow([str(100000 + i), str(17000 + i), f"תחנת רכבת {i}", '', f"{lat:.6f}", "34.800000", '1', '', '1'])
+    f.close()
+    counts['stops'] = stop_count + station_count
+
+    f, w = writer('agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang', 'agency_phone', 'agency_fare_url'])
+    agency_count = 20
+    for i in range(1, agency_count + 1):
+        w.writerow([str(i), f"מפעיל {i}" if i != 2 else 'רכבת ישראל', 'http://www.example.com', 'Asia/Jerusalem', 'he', '', ''])
+    f.close()
+    counts['agency'] = agency_count
+
+    routes_f, routes_w = writer('routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type', 'route_color'])
+    trips_f, trips_w = writer('trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id', 'wheelchair_accessible'])
+    stop_times_f, stop_times_w = writer('stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'pickup_type', 'drop_off_type', 'shape_dist_traveled'])
+    route_count = 0
+    trip_count = 0
+    stop_time_count = 0
+
+    def write_trip(route_id, trip_id, headsign, direction_id, stop_ids):
+        nonlocal trip_count, stop_time_count
+        trips_w.writerow([route_id, str(rng.randint(1, 50)), trip_id, headsign, direction_id, str(route_id), '1'])
+        minutes = rng.randint(300, 1400)
+        stop_times_w.writerows(
+            [trip_id, f"{(minutes + j) // 60:02}:{(minutes + j) % 60:02}:00", f"{(minutes + j) // 60:02}:{(minutes + j) % 60:02}:00", stop_id, str(j + 1), '0', '0', str(j * 400)]
+            for j, stop_id in enumerate(stop_ids))
+        trip_count += 1
+        stop_time_count += len(stop_ids)
+
+    # bus routes, in pairs: both directions of the same catalog number
+    for catalog in range(routes // 2):
+        catalog_number = str(10000 + catalog)
+        agency_id = str(rng.choice([1] + list(range(3, agency_count + 1))))
+        ref = str(catalog % 400 + 1) + ('' if catalog % 5 else 'א')
+        # a local route: nearby stops, mostly in the same city
+        first = rng.randrange(stop_count)
+        stop_ids = [str((first + rng.randint(0, 40)) % stop_count + 1) for _ in range(stops_per_trip)]
+        stop_ids = list(dict.fromkeys(stop_ids)) # no repeats
+        for direction_id in ('0', '1'):
+            route_id = str(route_count + 1)
+            route_count += 1
+            sequence = stop_ids if direction_id == '0' else stop_ids[::-1]
+            routes_w.writerow([route_id, agency_id, ref, f"{sequence[0]}<->{sequence[-1]}", f"{catalog_number}-{int(direction_id) + 1}-#", '3', ''])
+            headsign = f"{rng.choice(cities)}_{rng.choice(streets)}"
+            for k in range(trips_per_route):
+                write_trip(route_id, f"{route_id}_{k}", headsign, direction_id, sequence)
+
+    # train lines: the hundreds digit of the train number is the ref, each line is a sequence of stations
+    train_lines = min(9, max(1, routes // 100))
+    for ref in range(1, train_lines + 1):
+        first = rng.randrange(station_count - 10)
+        stations = [str(100000 + s) for s in range(first, min(station_count, first + rng.randint(8, 30)))]
+        train_number = ref * 100
+        for direction_id in ('0', '1'):
+            line = stations if direction_id == '0' else stations[::-1]
+            # the full line, a short turn, and two express patterns with the same endpoints that skip different stations
+            patterns = [line, line[:len(line) // 2 + 1], line[::2] + ([line[-1]] if len(line) % 2 == 0 else []), line[:1] + line[1:-1:3] + line[-1:]]
+            for sequence in patterns:
+                route_id = str(route_count + 1)
+                route_count += 1
+                routes_w.writerow([route_id, '2', '', f"{sequence[0]}-{sequence[-1]}", 'רכבת', '2', ''])
+                for k in range(max(1, trips_per_route // 3)):
+                    train_number += 1
+                    write_trip(route_id, f"{route_id}_{k}", str(train_number), direction_id, sequence)
+
+    routes_f.close()
+    trips_f.close()
+    stop_times_f.close()
+    counts['routes'] = route_count
+    counts['trips'] = trip_count
+    counts['stop_times'] = stop_time_count
+    return counts
+
+def write_shape(shape_file):
+    """GeoJSON polygon covering the middle third of the synthetic feed"""
+    lat1 = min_lat + (max_lat - min_lat) / 3
+    lat2 = min_lat + (max_lat - min_lat) * 2 / 3
+    polygon = {"type": "Polygon", "coordinates": [[[min_lon, lat1], [max_lon, lat1], [max_lon, lat2], [min_lon, lat2], [min_lon, lat1]]]}
+    with open(shape_file, 'w', encoding='utf-8') as f:
+        json.dump(polygon, f)
+
+def create_database(gtfs_dir, dbfile):
+    """Load a GTFS feed into a PTNA-style sqlite database, with the same keys and indexes as gtfs-prepare-ptna-sqlite.sh"""
+    if path.exists(dbfile):
+        os.remove(dbfile)
+    con = sqlite3.connect(dbfile)
+    primary_keys = {'agency': 'agency_id', 'routes': 'route_id', 'trips': 'trip_id', 'stops': 'stop_id'}
+    for table in ['agency', 'routes', 'trips', 'stops', 'stop_times']:
+        with open(path.join(gtfs_dir, f'{table}.txt'), newline='', encoding='utf_8_sig') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            columns = ', '.join(f"{c} TEXT PRIMARY KEY" if c == primary_keys.get(table) else f"{c} TEXT" for c in header)
+            con.execute(f"CREATE TABLE {table} ({columns});")
+            con.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(header))});", reader)
+    con.execute("CREATE INDEX idx_trip_id ON stop_times (trip_id);")
+    con.execute("CREATE INDEX idx_stop_id ON stop_times (stop_id);")
+    con.execute("CREATE INDEX idx_route_id ON trips (route_id);")
+
+    con.execute("CREATE TABLE gtfs_route_types (route_type INTEGER PRIMARY KEY UNIQUE, sort_key INTEGER DEFAULT 9999, string TEXT, osm_route TEXT);")
+    with open(path.join(path.dirname(bin_dir), 'gtfs_route_types.txt'), newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)
+        con.executemany("INSERT INTO gtfs_route_types VALUES (?, ?, ?, ?);", reader)
+    con.execute("CREATE INDEX idx_gtfs_route_types ON gtfs_route_types (route_type);")
+    con.commit()
+    con.close()
+
+def prepare(workdir, scale):
+    """Generate the feed, shape and database in workdir, unless they are already there for the same scale"""
+    os.makedirs(workdir, exist_ok=True)
+    info_file = path.join(workdir, 'feed.json')
+    if path.exists(info_file):
+        with open(info_file, encoding='utf-8') as f:
+            info = json.load(f)
+        if info['scale'] == scale:
+            print(f"Using existing synthetic feed in {workdir}")
+            return info
+
+    print(f"Generating synthetic feed in {workdir}: {scale}")
+    gtfs_dir = path.join(workdir, 'gtfs')
+    start = time.perf_counter()
+    counts = generate_feed(gtfs_dir, **scale)
+    write_shape(path.join(workdir, 'shape.geojson'))
+    print(f"Generated {counts} in {time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    create_database(gtfs_dir, path.join(workdir, 'ptna-gtfs-sqlite.db'))
+    print(f"Created database in {time.perf_counter() - start:.1f}s")
+
+    info = {'scale': scale, 'counts': counts}
+    with open(info_file, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    return info
+### end synthetic feed ###
+
+### Benchmark runs ###
+def run_one(spec):
+    """Run a single benchmark in this process and return its measurements. Called in a child process."""
+    sys.path.insert(0, bin_dir)
+    workdir = spec['workdir']
+    out_file = path.join(workdir, f"out-{spec['tool']}-{spec['scenario']}.json")
+    log_file = path.join(workdir, f"log-{spec['tool']}-{spec['scenario']}.txt")
+    with open(log_file, 'w', encoding='utf-8') as log, redirect_stdout(log):
+        if spec['tool'] == 'generic':
+            import genericGtfsImport
+            options = dict(generic_scenarios[spec['scenario']])
+            properties = options.pop('properties')
+            start = time.perf_counter()
+            importer = genericGtfsImport.PtnaRoutesImporter('BENCHMARK', path.join(workdir, 'ptna-gtfs-sqlite.db'), **options)
+            for prop, source in properties.items():
+                importer.set_route_property(prop, source)
+            importer.main(out_file)
+        else:
+            import israelGtfsRoutesInShape
+            options = israel_scenarios[spec['scenario']]
+            start = time.perf_counter()
+            database = path.join(workdir, 'ptna-gtfs-sqlite.db') if options.get('database') else None
+            israelGtfsRoutesInShape.main(path.join(workdir, 'shape.geojson'), options['trains'], path.join(workdir, 'gtfs'), out_file, database=database)
+        wall_time = time.perf_counter() - start
+
+    with open(out_file, encoding='utf-8') as f:
+        output_entries = len(json.load(f))
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {'wall_time_s': round(wall_time, 3), 'peak_rss_kb': peak_rss, 'output_entries': output_entries}
+
+def run_benchmarks(workdir, tools, scenarios, repeat):
+    runs = []
+    for tool in tools:
+        tool_scenarios = generic_scenarios if tool == 'generic' else israel_scenarios
+        for scenario in tool_scenarios:
+            if scenarios and scenario not in scenarios:
+                continue
+            for i in range(repeat):
+                spec = {'tool': tool, 'scenario': scenario, 'workdir': workdir}
+                with tempfile.NamedTemporaryFile('r', suffix='.json', encoding='utf-8') as result_file:
+                    # a fresh process for each run, so peak RSS is of this run only
+                    subprocess.run([sys.executable, path.abspath(__file__), '--run-one', json.dumps(spec), result_file.name], check=True)
+                    result = json.load(result_file)
+                run = {'tool': tool, 'scenario': scenario, 'repeat': i, **result}
+                print(f"{tool} {scenario} #{i}: {run['wall_time_s']}s, peak RSS {run['peak_rss_kb']} KB, {run['output_entries']} routes")
+                runs.append(run)
+    return runs
+### end benchmark runs ###
+
+def main():
+    if sys.argv[1:2] == ['--run-one']:
+        # child process started by run_benchmarks
+        spec, result_file = sys.argv[2:4]
+        result = run_one(json.loads(spec))
+        with open(result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark genericGtfsImport.py and israelGtfsRoutesInShape.py on synthetic feeds",
+        epilog='''Example:
+  %(prog)s --scale 10k --workdir /tmp/gtfs-benchmark --output results.json''', formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=scales.keys(), default='1k', help='preset feed size (default: 1k)')
+    parser.add_argument('--routes', type=int, help='number of bus routes, overrides --scale')
+    parser.add_argument('--trips-per-route', type=int, help='overrides --scale')
+    parser.add_argument('--stops-per-trip', type=int, help='overrides --scale')
+    parser.add_argument('-w', '--workdir', required=True, help='directory for the synthetic feed, database and outputs - reused if the scale is the same')
+    parser.add_argument('-o', '--output', required=True, help='results output file (.json)')
+    parser.add_argument('--tools', nargs='+', choices=['generic', 'israel'], default=['generic', 'israel'], help='tools to benchmark (default: both)')
+    parser.add_argument('--scenarios', nargs='+', choices=list(generic_scenarios) + list(israel_scenarios), help='scenarios to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each scenario (default: 1)')
+    args = parser.parse_args()
+
+    scale = dict(scales[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    workdir = path.abspath(args.workdir)
+    feed = prepare(workdir, scale)
+    runs = run_benchmarks(workdir, args.tools, args.scenarios, args.repeat)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'feed': feed,
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -9,143 +9,695 @@
 import csv
 import re
 import argparse
+import hashlib
 import json
+import os
+import sqlite3
+import zipfile
+import numpy as np
 import shapely
 from os import path
 from collections import Counter, defaultdict
-
-def main(shape_file, trains, gtfs_dir, out_file):
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from io import TextIOWrapper
+from itertools import groupby, repeat
+from operator import itemgetter
+from genericGtfsImport import CachedNormalizer, active_service_ids, sqlite3_connect_read_only, write_routes
+
+def main(shape_file, trains, gtfs_dir, out_file, ndjson=False, cache_dir=None, database=None, jobs=1, active_dates=None):
+    main_batch([] if trains else [shape_file], trains, gtfs_dir, [out_file], ndjson, cache_dir, database, jobs, active_dates)
+
+def main_batch(shape_files, trains, gtfs_dir, out_files, ndjson=False, cache_dir=None, database=None, jobs=1, active_dates=None):
+    # create a catalog for each shape file, parsing the GTFS files only once for all of them
+    # out_files has an output file for each shape file (or a single output file if trains is True)
+    # if cache_dir is given, the parsed GTFS files are cached there for the next runs (see load_gtfs)
+    # if database is given, the GTFS data is read from this PTNA sqlite database instead of gtfs_dir (see load_gtfs_database)
+    # jobs is the number of processes for parsing stop_times.txt
+    # if active_dates is given as (first date, last date), only the trips that run on at least one of those days are used (see drop_inactive_trips)
     use_shape = not trains
-    # Use a polygon to select stops
-    shape = None
+    # Use polygons to select stops
+    shapes = []
     if use_shape:
-        shape = get_shape(shape_file)
-        print(f'get_shape returned a shape with {shapely.get_num_geometries(shape)} geometries and {shapely.get_num_coordinates(shape)} coordinates')
+        for shape_file in shape_files:
+            shape = get_shape(shape_file)
+            print(f'get_shape returned a shape with {shapely.get_num_geometries(shape)} geometries and {shapely.get_num_coordinates(shape)} coordinates from {shape_file}')
+            shapes.append(shape)
 
     # Find routes that stop at these stops
     # (this section is to be replaced with some SQL magic)
+    if database:
+        feed = load_gtfs_database(database)
+    else:
+        feed = load_gtfs(gtfs_dir, cache_dir, jobs)
+    if active_dates:
+        feed = drop_inactive_trips(feed, *active_dates)
     train_data = {}
-    stop_ids, all_stops = stop_ids_from_shape(gtfs_dir, shape, trains, train_data)
-    print(f"{len(stop_ids)} stop_ids, {len(train_data['stops_by_stop_id'])} train stops out of stop_ids_from_shape")
-    internal_trip_ids, connecting_trip_ids, cities_by_trip_id = trip_ids_from_stop_ids(gtfs_dir, stop_ids, train_data, all_stops)
-    print(f"{len(internal_trip_ids)} internal trips, {len(connecting_trip_ids)} connecting trips, {len(train_data['sequence_by_trip_id'])} train sequences out of trip_ids_from_stop_ids")
-    route_info, internal_route_ids = route_ids_from_trip_ids(gtfs_dir, internal_trip_ids, connecting_trip_ids, train_data, cities_by_trip_id)
-    print(f"{len(route_info)} route_ids out of route_ids_from_trip_ids, of which {len(internal_route_ids)} are internal. Also {len(train_data['trip_by_trip_id'])} train trips.")
-    routes = routes_from_route_ids(gtfs_dir, route_info)
-    print(f"{len(routes)} routes out of routes_from_route_ids")
-    populate_agency_name_for_routes(gtfs_dir, routes)
-
-    # print some statistics
-    print("Operators breakdown:")
-    for operator, count in Counter(route['agency_name'] for route in routes).most_common():
-        print(count, operator)
+    stops_in_regions = stops_from_shapes(feed, shapes, trains, train_data)
+    print(f"{', '.join(str(stop_count) for stop_count in stops_in_regions.sum(axis=1).tolist())} stop_ids, {len(train_data['stops_by_stop_id'])} train stops out of stops_from_shapes")
+    regions_by_stop_pattern, cities_by_stop_pattern, city_names = stop_patterns_from_stops(feed, stops_in_regions, train_data)
+    for internal_trip_count, connecting_trip_count in count_trips_by_region(feed, regions_by_stop_pattern, len(stops_in_regions)):
+        print(f"{internal_trip_count} internal trips, {connecting_trip_count} connecting trips out of stop_patterns_from_stops")
+    print(f"{len(train_data['sequence_by_trip_id'])} train sequences out of stop_patterns_from_stops")
+    route_ids_by_region = route_ids_from_stop_patterns(feed, regions_by_stop_pattern, cities_by_stop_pattern, len(stops_in_regions), train_data)
+    for route_info, internal_route_ids in route_ids_by_region:
+        print(f"{len(route_info)} route_ids out of route_ids_from_stop_patterns, of which {len(internal_route_ids)} are internal.")
+    print(f"{len(train_data['trip_by_trip_id'])} train trips out of route_ids_from_stop_patterns")
+    routes_by_region = routes_from_route_ids(feed, [route_info for route_info, internal_route_ids in route_ids_by_region])
+    populate_agency_name_for_routes(feed, [route for routes in routes_by_region for route in routes])
 
     process_train_data(train_data)
 
-    routes_by_catalog_number = group_routes_by_catalog_number(routes, train_data)
-    print(f"{len(routes_by_catalog_number)} catalog numbers from routes_by_catalog_number")
-    catalog = create_ptna_routes(routes_by_catalog_number, internal_route_ids)
-    print(f"{len(catalog)} routes in the final catalog, of which {sum(1 for r in catalog if r['internal'] == 'yes')} are internal")
-    sort_catalog(catalog)
-    print(f"Saving routes to {out_file}")
-    dump_catalog(catalog, out_file)
+    for routes, (route_info, internal_route_ids), out_file in zip(routes_by_region, route_ids_by_region, out_files):
+        print(f"Creating catalog {out_file}")
+        print(f"{len(routes)} routes out of routes_from_route_ids")
+
+        # print some statistics
+        print("Operators breakdown:")
+        for operator, count in Counter(route['agency_name'] for route in routes).most_common():
+            print(count, operator)
+
+        routes_by_catalog_number = group_routes_by_catalog_number(routes, train_data)
+        print(f"{len(routes_by_catalog_number)} catalog numbers from routes_by_catalog_number")
+        catalog = create_ptna_routes(routes_by_catalog_number, internal_route_ids, city_names)
+        print(f"{len(catalog)} routes in the final catalog, of which {sum(1 for r in catalog if r['internal'] == 'yes')} are internal")
+        sort_catalog(catalog)
+        print(f"Saving routes to {out_file}")
+        dump_catalog(catalog, out_file, ndjson)
+    fix_gtfs_name.report()
 
 ### GTFS parsing - this part should be replaced with some SQL queries ###
-def fix_gtfs_name(s):
+multiple_spaces_re = re.compile(' +')
+gershayim_re = re.compile('(?<=[א-ת])"(?=[א-ת])') # note: א-ת includes אותיות סופיות
+geresh_re = re.compile("(?<=[א-ת])'")
+stop_desc_city_re = re.compile(r'רחוב: .* עיר: (.*) רציף: .* קומה: .*')
+
+def normalize_gtfs_name(s):
     # GTFS has bad names
     s = s.replace("''", '"')
     s = s.replace('""', '"') # one occurrence of this (גן טכנולוגי/א''''ס הפועל)
     s = s.replace('\xa0', ' ') # non-breaking space
     s = s.strip()
     if not s: return s
-    s = re.sub(' +', ' ', s)
-    s = re.sub('(?<=[א-ת])"(?=[א-ת])', '״', s) # Hebrew Gershayim (note: א-ת includes אותיות סופיות)
+    s = multiple_spaces_re.sub(' ', s)
+    s = gershayim_re.sub('״', s) # Hebrew Gershayim
     if s[0] == "'": # sometimes they put the Geresh on the wrong side, probably bad RTL support in their GUI
         s = s[1:] + "'"
-    s = re.sub("(?<=[א-ת])'", '׳', s) # Hebrew Geresh
+    s = geresh_re.sub('׳', s) # Hebrew Geresh
     return s
 
-
-def stop_ids_from_shape(gtfs_dir, shape, trains, train_data):
-    # return value:
-    # 1. stop_ids: set of stop_ids within this shape
-    # 2. all_stops: dict mapping stop_id to stop struct for all stops in GTFS
-    # if trains is True, stop_ids will have the stop_ids of all train stations and nothing else (shape is not used)
-    # this function also adds to train_data:
-    # stops_by_stop_id: dict mapping stop_id to stop struct
-    stop_ids = set()
+# the same names appear many times, so normalize each one only once
+fix_gtfs_name = CachedNormalizer(normalize_gtfs_name)
+
+
+def load_gtfs(gtfs_dir, cache_dir=None, jobs=1):
+    # return value: feed, a dict with the parts of the GTFS data that are the same for all regions:
+    # gtfs_dir: the directory of the GTFS files, or the GTFS .zip file (or database: a connection to the PTNA sqlite database, see load_gtfs_database)
+    # stops_by_stop_id: dict mapping stop_id to stop struct for all stops in GTFS, with fixed name and added city field
+    # train_stops_by_stop_id: dict mapping stop_id to stop struct, train stations only
+    # stop_ids: list of all stop_ids, the stop number of a stop is its index in this list (stops_by_stop_id is in the same order)
+    # trip_ids: list of all trip_ids, the trip number of a trip is its index in this list
+    # stop_pattern_by_trip: array with the stop pattern number of each trip number
+    # stop_pattern_offsets, stop_pattern_stops: the stop patterns - the distinct sets of stops that trips stop at:
+    #   the sorted stop numbers of stop pattern i are stop_pattern_stops[stop_pattern_offsets[i]:stop_pattern_offsets[i + 1]]
+    # train_sequence_by_trip_id: dict mapping trip_id to a tuple of the train station stop_ids in its route
+    # tables: dict mapping the names of other GTFS files (trips, routes, agency) to their columns, if they were read already (see gtfs_rows)
+    # if cache_dir is given, feed is loaded from the cache in that directory, or saved there if the cache is missing or out of date
+    # jobs is the number of processes for parsing stop_times.txt
+    if cache_dir:
+        feed = load_gtfs_cache(gtfs_dir, cache_dir)
+        if feed:
+            return feed
+    feed = {'gtfs_dir': gtfs_dir, 'tables': {}}
+    parse_stops(feed)
+    parse_stop_times(feed, jobs)
+    if cache_dir:
+        for table in cached_tables:
+            feed['tables'][table] = read_gtfs_columns(gtfs_dir, table)
+        save_gtfs_cache(feed, cache_dir)
+    return feed
+
+def load_gtfs_database(db_file):
+    # return value: feed (see load_gtfs), with the GTFS data read from the sqlite database that PTNA creates for the feed
+    # the stops of each trip are collected by the database, so stop_times are not read into Python one by one
+    con = sqlite3_connect_read_only(db_file)
+    con.row_factory = sqlite3.Row
+    feed = {'database': con, 'tables': {}}
+    parse_stops(feed)
+    query_stop_times(feed)
+    return feed
+
+def parse_stops(feed):
     all_stops = {}
     train_stops_by_stop_id = {}
-    if not trains:
-        shapely.prepare(shape)
-    print("Parsing stops.txt")
-    with open(path.join(gtfs_dir, 'stops.txt'), newline='', encoding='utf_8_sig') as f:
-        csv_reader = csv.DictReader(f)
-        for stop in csv_reader:
-            # add to all_stops with fixed name and added city field
-            all_stops[stop['stop_id']] = stop
-            stop['stop_name'] = fix_gtfs_name(stop['stop_name'])
-            city_re = re.fullmatch(r'רחוב: .* עיר: (.*) רציף: .* קומה: .*', stop['stop_desc'])
-            if city_re:
-                stop['city'] = fix_gtfs_name(city_re.group(1))
-            # add train stations to train_data
-            if not stop['stop_desc']:
-                # train station
-                train_stops_by_stop_id[stop['stop_id']] = stop
-                if trains:
-                    stop_ids.add(stop['stop_id'])
-            # add stops in the shape
-            if not trains and shapely.contains_xy(shape, float(stop['stop_lon']), float(stop['stop_lat'])):
-                stop_ids.add(stop['stop_id'])
-            elif trains and re.match(r'רחוב: מסילת (ברזל |קו )', stop['stop_desc']):
-                # add light rail stops as well
-                # eventually replace this bullshit logic with querying route_type over SQL instead of going by stops
-                # but right now, this is the easiest way
-                stop_ids.add(stop['stop_id'])
-    train_data['stops_by_stop_id'] = train_stops_by_stop_id
-    return stop_ids, all_stops
-
-def trip_ids_from_stop_ids(gtfs_dir, stop_ids, train_data, all_stops):
+    for stop in gtfs_rows(feed, 'stops'):
+        # add to all_stops with fixed name and added city field
+        all_stops[stop['stop_id']] = stop
+        stop['stop_name'] = fix_gtfs_name(stop['stop_name'])
+        city_re = stop_desc_city_re.fullmatch(stop['stop_desc'])
+        if city_re:
+            stop['city'] = fix_gtfs_name(city_re.group(1))
+        if not stop['stop_desc']:
+            # train station
+            train_stops_by_stop_id[stop['stop_id']] = stop
+    feed['stops_by_stop_id'] = all_stops
+    feed['train_stops_by_stop_id'] = train_stops_by_stop_id
+
+class StopPatterns:
+    # collects the distinct sets of stops of trips into feed (see load_gtfs)
+    # while parsing, trips and stops are kept by their GTFS ids, and numbered in finish()
+    def __init__(self, feed):
+        self.feed = feed
+        self.stop_patterns = []
+        self.stop_pattern_by_trip_id = {}
+        self.stop_pattern_index = {}
+
+    def add_trip(self, trip_id, stop_ids):
+        if trip_id in self.stop_pattern_by_trip_id:
+            # the stop_times of this trip are not all in one block
+            stop_ids = self.stop_patterns[self.stop_pattern_by_trip_id[trip_id]].union(stop_ids)
+        stop_ids = frozenset(stop_ids)
+        if stop_ids not in self.stop_pattern_index:
+            self.stop_pattern_index[stop_ids] = len(self.stop_patterns)
+            self.stop_patterns.append(stop_ids)
+        self.stop_pattern_by_trip_id[trip_id] = self.stop_pattern_index[stop_ids]
+
+    def finish(self):
+        print(f"{len(self.stop_pattern_by_trip_id)} trips with {len(self.stop_pattern_index)} different sets of stops")
+        feed = self.feed
+        stop_ids = feed['stop_ids'] = list(feed['stops_by_stop_id'])
+        stop_number_by_stop_id = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+
+        def stop_number(stop_id):
+            if stop_id not in stop_number_by_stop_id:
+                # not in stops.txt
+                stop_number_by_stop_id[stop_id] = len(stop_ids)
+                stop_ids.append(stop_id)
+            return stop_number_by_stop_id[stop_id]
+
+        feed['trip_ids'] = list(self.stop_pattern_by_trip_id)
+        feed['stop_pattern_by_trip'] = np.fromiter(self.stop_pattern_by_trip_id.values(), dtype=np.int32, count=len(self.stop_pattern_by_trip_id))
+        feed['stop_pattern_offsets'] = np.cumsum([0] + [len(stop_pattern) for stop_pattern in self.stop_patterns], dtype=np.int64)
+        feed['stop_pattern_stops'] = np.fromiter((number for stop_pattern in self.stop_patterns for number in sorted(map(stop_number, stop_pattern))),
+            dtype=np.int32, count=int(feed['stop_pattern_offsets'][-1]))
+
+def add_train_stop_time(train_trip_sequence_dict_by_trip_id, trip_id, stop_id, stop_sequence):
+    sequence_dict = train_trip_sequence_dict_by_trip_id[trip_id]
+    if str(int(stop_sequence)) != stop_sequence:
+        print(f"Warning: weird number formatting '{stop_sequence}' in stop_sequence for trip_id {trip_id}")
+    stop_seq = int(stop_sequence)
+    assert stop_seq not in sequence_dict
+    sequence_dict[stop_seq] = stop_id
+
+def train_sequences(train_trip_sequence_dict_by_trip_id):
+    # convert sequence dicts to sequence tuples
+    return {trip_id: tuple(sequence[i] for i in sorted(sequence.keys())) for trip_id, sequence in train_trip_sequence_dict_by_trip_id.items()}
+
+def parse_stop_times(feed, jobs=1):
+    # with jobs > 1, stop_times.txt is split into parts that are parsed in parallel processes
+    gtfs_dir = feed['gtfs_dir']
+    train_stop_ids = set(feed['train_stops_by_stop_id'])
+    if jobs > 1 and is_gtfs_zip(gtfs_dir):
+        # a compressed file can't be read from the middle without decompressing everything before it
+        print("stop_times.txt is in a .zip file, parsing it in one process")
+        jobs = 1
+    columns, byte_ranges = split_gtfs_file(gtfs_dir, 'stop_times', ('trip_id', 'stop_id', 'stop_sequence'), jobs * 4 if jobs > 1 else 1)
+    if jobs > 1:
+        print(f"Parsing stop_times.txt in {len(byte_ranges)} parts with {jobs} processes")
+        with ProcessPoolExecutor(jobs) as executor:
+            parts = executor.map(scan_stop_times, repeat(gtfs_dir), repeat(columns), byte_ranges, repeat(train_stop_ids))
+            merge_stop_times_parts(feed, parts)
+    else:
+        print("Parsing stop_times.txt")
+        merge_stop_times_parts(feed, (scan_stop_times(gtfs_dir, columns, byte_range, train_stop_ids) for byte_range in byte_ranges))
+
+def scan_stop_times(gtfs_dir, columns, byte_range, train_stop_ids):
+    # parse the stop_times in byte_range of stop_times.txt (see split_gtfs_file) - runs in a separate process if jobs > 1
+    # columns are the indexes of trip_id, stop_id and stop_sequence
     # return values:
-    # 1. internal_trip_ids - trips that only stop at the given stops
-    # 2. connecting_trip_ids - trips that stop at the given stops as well as other stops (i.e. connect to other districts/regions)
-    # 3. cities_by_trip_id - dict from trip_id to a set of city names in which the trip stops
-    # this function also adds to train_data:
-    # sequence_by_trip_id - dict mapping trip_id to a tuple of the stop_ids in its route
-    in_trip_ids = set()
-    out_trip_ids = set()
+    # 1. stop_patterns - list of the distinct sets of stop_ids (frozensets) of the trips in this part
+    # 2. trip_stop_patterns - list of (trip_id, index in stop_patterns) for each block of consecutive stop_times of the same trip
+    # 3. train_stop_times - list of (trip_id, stop_id, stop_sequence) of the stop_times at train stations, in order
+    stop_pattern_index = {}
+    trip_stop_patterns = []
+    train_stop_times = []
+
+    def add_trip(trip_id, stop_ids):
+        trip_stop_patterns.append((trip_id, stop_pattern_index.setdefault(frozenset(stop_ids), len(stop_pattern_index))))
+
+    # stop_times are grouped by trip, collect the stops of each trip until the next trip starts
+    # (which may be in the next batch)
+    trip_id = None
+    stop_ids = set()
+    for batch in scan_gtfs_file(gtfs_dir, 'stop_times', columns, byte_range):
+        for batch_trip_id, stop_times in groupby(batch, key=itemgetter(0)):
+            stop_times = list(stop_times)
+            batch_stop_ids = {stop_id for _, stop_id, _ in stop_times}
+            if batch_trip_id == trip_id:
+                stop_ids |= batch_stop_ids
+            else:
+                if trip_id is not None:
+                    add_trip(trip_id, stop_ids)
+                trip_id = batch_trip_id
+                stop_ids = batch_stop_ids
+            if not batch_stop_ids.isdisjoint(train_stop_ids):
+                train_stop_times += (stop_time for stop_time in stop_times if stop_time[1] in train_stop_ids)
+    if trip_id is not None:
+        add_trip(trip_id, stop_ids)
+    return list(stop_pattern_index), trip_stop_patterns, train_stop_times
+
+def merge_stop_times_parts(feed, parts):
+    # combine the return values of scan_stop_times for all parts of stop_times.txt, in order, into the feed
+    # as if the whole file was parsed at once
+    stop_patterns = StopPatterns(feed)
     train_trip_sequence_dict_by_trip_id = defaultdict(dict)
-    cities_by_trip_id = defaultdict(set)
-    print("Parsing stop_times.txt")
-    with open(path.join(gtfs_dir, 'stop_times.txt'), newline='', encoding='utf_8_sig') as f:
-        csv_reader = csv.DictReader(f)
-        for stop_time in csv_reader:
-            if 'city' in all_stops[stop_time['stop_id']]:
-                cities_by_trip_id[stop_time['trip_id']].add(all_stops[stop_time['stop_id']]['city'])
-            if stop_time['stop_id'] in train_data['stops_by_stop_id']:
-                sequence_dict = train_trip_sequence_dict_by_trip_id[stop_time['trip_id']]
-                if str(int(stop_time['stop_sequence'])) != stop_time['stop_sequence']:
-                    print(f"Warning: weird number formatting '{stop_time['stop_sequence']}' in stop_sequence for trip_id {stop_time['trip_id']}")
-                stop_seq = int(stop_time['stop_sequence'])
-                assert stop_seq not in sequence_dict
-                sequence_dict[stop_seq] = stop_time['stop_id']
-            if stop_time['stop_id'] in stop_ids:
-                in_trip_ids.add(stop_time['trip_id'])
+    # a trip can continue from one part to the next
+    trip_id = None
+    stop_ids = frozenset()
+    for part_stop_patterns, trip_stop_patterns, train_stop_times in parts:
+        for part_trip_id, stop_pattern in trip_stop_patterns:
+            if part_trip_id == trip_id:
+                stop_ids = stop_ids | part_stop_patterns[stop_pattern]
             else:
-                out_trip_ids.add(stop_time['trip_id'])
-    internal_trip_ids = in_trip_ids - out_trip_ids
-    connecting_trip_ids = in_trip_ids & out_trip_ids
-    assert internal_trip_ids.isdisjoint(connecting_trip_ids)
-    assert internal_trip_ids | connecting_trip_ids == in_trip_ids
+                if trip_id is not None:
+                    stop_patterns.add_trip(trip_id, stop_ids)
+                trip_id = part_trip_id
+                stop_ids = part_stop_patterns[stop_pattern]
+        for stop_time in train_stop_times:
+            add_train_stop_time(train_trip_sequence_dict_by_trip_id, *stop_time)
+    if trip_id is not None:
+        stop_patterns.add_trip(trip_id, stop_ids)
+    stop_patterns.finish()
+    feed['train_sequence_by_trip_id'] = train_sequences(train_trip_sequence_dict_by_trip_id)
+
+def query_stop_times(feed):
+    # like parse_stop_times, with set-based queries instead of reading every stop_time
+    con = feed['database']
+    stop_patterns = StopPatterns(feed)
+    print("Querying stop_times for the stops of each trip")
+    for trip_id, stop_ids in con.execute("SELECT trip_id, json_group_array(stop_id) FROM stop_times GROUP BY trip_id;"):
+        stop_patterns.add_trip(trip_id, json.loads(stop_ids))
+    stop_patterns.finish()
+
+    print("Querying stop_times for train stations")
+    train_trip_sequence_dict_by_trip_id = defaultdict(dict)
+    con.execute("CREATE TEMP TABLE train_stop_ids (stop_id TEXT PRIMARY KEY);")
+    con.executemany("INSERT INTO temp.train_stop_ids VALUES (?);", ((stop_id,) for stop_id in feed['train_stops_by_stop_id']))
+    for trip_id, stop_id, stop_sequence in con.execute("SELECT trip_id, stop_id, stop_sequence FROM stop_times WHERE stop_id IN temp.train_stop_ids ORDER BY rowid;"):
+        add_train_stop_time(train_trip_sequence_dict_by_trip_id, trip_id, stop_id, stop_sequence)
+    feed['train_sequence_by_trip_id'] = train_sequences(train_trip_sequence_dict_by_trip_id)
+
+def drop_inactive_trips(feed, first_date, last_date):
+    # return value: a copy of feed without the trips that don't run on any day from first_date to last_date (datetime.date, inclusive)
+    # the active service_ids are found in calendar.txt and calendar_dates.txt (see active_service_ids)
+    # feed itself stays the same, so the GTFS cache doesn't depend on the dates
+    # the train sequences of inactive trips are kept for the order of the stations (see process_train_data), active_train_trip_ids has the active ones
+    calendar = gtfs_rows(feed, 'calendar') if has_gtfs_table(feed, 'calendar') else []
+    calendar_dates = gtfs_rows(feed, 'calendar_dates') if has_gtfs_table(feed, 'calendar_dates') else []
+    if not calendar and not calendar_dates:
+        raise FileNotFoundError("Active dates require calendar.txt or calendar_dates.txt")
+    service_ids = active_service_ids(calendar, calendar_dates, first_date, last_date)
+    print(f"{len(service_ids)} service_ids active from {first_date} to {last_date}")
+    if 'database' not in feed and 'trips' not in feed['tables']:
+        # keep trips.txt, so that route_ids_from_stop_patterns doesn't parse it again
+        feed['tables']['trips'] = read_gtfs_columns(feed['gtfs_dir'], 'trips')
+    active_trip_ids = {trip['trip_id'] for trip in gtfs_rows(feed, 'trips') if trip['service_id'] in service_ids}
+    active_trips = np.array([trip_id in active_trip_ids for trip_id in feed['trip_ids']], dtype=bool)
+    active_feed = dict(feed)
+    active_feed['trip_ids'] = [trip_id for trip_id, active in zip(feed['trip_ids'], active_trips.tolist()) if active]
+    active_feed['stop_pattern_by_trip'] = feed['stop_pattern_by_trip'][active_trips]
+    active_feed['active_train_trip_ids'] = {trip_id for trip_id in feed['train_sequence_by_trip_id'] if trip_id in active_trip_ids}
+    print(f"{len(active_feed['trip_ids'])} of {len(feed['trip_ids'])} trips are active")
+    return active_feed
+
+def rail_stop_ids(feed):
+    # return value: set of the stop_ids of train and light rail routes
+    con = feed['database']
+    print("Querying stop_times for the stops of train and light rail routes")
+    query = """SELECT DISTINCT stop_id FROM stop_times
+        WHERE trip_id IN (SELECT trip_id FROM trips
+                          WHERE route_id IN (SELECT route_id FROM routes WHERE CAST(route_type AS INTEGER) IN (0, 2)));"""
+    return {stop_id for stop_id, in con.execute(query)}
+
+def read_gtfs_columns(gtfs_dir, table):
+    # return value: tuple of (column names, list of values for each column) of <table>.txt
+    print(f"Parsing {table}.txt")
+    with open_gtfs_file(gtfs_dir, table) as f:
+        csv_reader = csv.DictReader(f)
+        columns = {name: [] for name in csv_reader.fieldnames}
+        for row in csv_reader:
+            for name, values in columns.items():
+                values.append(row[name])
+    return list(columns), list(columns.values())
 
-    # convert sequence dicts to sequence tuples
-    train_data['sequence_by_trip_id'] = {trip_id: tuple(sequence[i] for i in sorted(sequence.keys())) for trip_id, sequence in train_trip_sequence_dict_by_trip_id.items()}
-    return internal_trip_ids, connecting_trip_ids, cities_by_trip_id
+def split_gtfs_file(gtfs_dir, table, columns, parts):
+    # return values:
+    # 1. the indexes of columns in <table>.txt
+    # 2. list of (start, end) byte ranges that split the lines after the header into up to `parts` parts of similar size
+    size = gtfs_file_stat(gtfs_dir, table)[0]
+    with open_gtfs_file(gtfs_dir, table, binary=True) as f:
+        header = f.readline()
+        boundaries = [f.tell()]
+        for i in range(1, parts):
+            # move each boundary to the start of the next line
+            f.seek(boundaries[0] + (size - boundaries[0]) * i // parts - 1)
+            f.readline()
+            if boundaries[-1] < f.tell() < size:
+                boundaries.append(f.tell())
+        boundaries.append(size)
+    header = next(csv.reader([header.decode('utf_8_sig')]))
+    return [header.index(column) for column in columns], list(zip(boundaries, boundaries[1:]))
+
+def scan_gtfs_file(gtfs_dir, table, columns, byte_range, block_size=1 << 22):
+    # generate lists of the rows in byte_range of <table>.txt, one block at a time, where each row is a tuple of the values at the indexes in columns
+    # much faster than csv.DictReader for big files, because no dict is made for each row
+    start, end = byte_range
+    get_columns = itemgetter(*columns)
+    with open_gtfs_file(gtfs_dir, table, binary=True) as f:
+        f.seek(start)
+        remaining = end - start
+        rest = b''
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            block = rest + block
+            # keep the partial last line for the next block
+            cut = block.rfind(b'\n') + 1 if remaining > 0 else len(block)
+            block, rest = block[:cut], block[cut:]
+            # empty lines are skipped, like csv.DictReader
+            yield list(map(get_columns, filter(None, csv.reader(block.decode('utf-8').split('\n')))))
+
+def gtfs_rows(feed, table):
+    # generate the rows of <table>.txt as dicts, like csv.DictReader
+    if table in feed['tables']:
+        names, columns = feed['tables'][table]
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+        return
+    if 'database' in feed:
+        print(f"Reading {table} from database")
+        for row in feed['database'].execute(f"SELECT * FROM {table} ORDER BY rowid;"):
+            yield dict(row)
+        return
+    print(f"Parsing {table}.txt")
+    with open_gtfs_file(feed['gtfs_dir'], table) as f:
+        yield from csv.DictReader(f)
+
+def has_gtfs_table(feed, table):
+    # whether the feed has <table>.txt (or the database has the table), for optional GTFS files
+    if table in feed['tables']:
+        return True
+    if 'database' in feed:
+        return feed['database'].execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table,)).fetchone() is not None
+    try:
+        gtfs_file_stat(feed['gtfs_dir'], table)
+    except FileNotFoundError:
+        return False
+    return True
+
+def is_gtfs_zip(gtfs_dir):
+    return path.isfile(gtfs_dir) and zipfile.is_zipfile(gtfs_dir)
+
+def gtfs_zip_member(zip_file, table):
+    # return value: the name of <table>.txt in the zip file
+    # the files are usually at the top level, but some feeds have them in a single directory
+    name = f'{table}.txt'
+    names = zip_file.namelist()
+    if name in names:
+        return name
+    found = [member for member in names if member.count('/') == 1 and member.endswith(f'/{name}')]
+    if len(found) != 1:
+        raise FileNotFoundError(f"{name} not found in {zip_file.filename}")
+    return found[0]
+
+def open_gtfs_file(gtfs_dir, table, binary=False):
+    # open <table>.txt in gtfs_dir, which is either a directory or a .zip file that is read without unpacking it
+    # text files are opened like csv.reader expects them
+    if not is_gtfs_zip(gtfs_dir):
+        if binary:
+            return open(path.join(gtfs_dir, f'{table}.txt'), 'rb')
+        return open(path.join(gtfs_dir, f'{table}.txt'), newline='', encoding='utf_8_sig')
+    # the member stays readable after the zip file is closed
+    with zipfile.ZipFile(gtfs_dir) as zip_file:
+        f = zip_file.open(gtfs_zip_member(zip_file, table))
+    if binary:
+        return f
+    return TextIOWrapper(f, newline='', encoding='utf_8_sig')
+
+def gtfs_file_stat(gtfs_dir, table):
+    # return value: (size, modification time in ns) of <table>.txt
+    # for a .zip file, the size is the uncompressed size and the time is the time of the .zip file
+    if not is_gtfs_zip(gtfs_dir):
+        stat = os.stat(path.join(gtfs_dir, f'{table}.txt'))
+        return stat.st_size, stat.st_mtime_ns
+    with zipfile.ZipFile(gtfs_dir) as zip_file:
+        size = zip_file.getinfo(gtfs_zip_member(zip_file, table)).file_size
+    return size, os.stat(gtfs_dir).st_mtime_ns
+
+### GTFS cache ###
+# The cache is a .npz file with the contents of feed, and a .json file with the size, modification time and hash of the GTFS files it was made from.
+# Strings are stored as a table of distinct strings plus an array of indexes into the table.
+cache_version = 2
+cached_files = ['agency.txt', 'routes.txt', 'stops.txt', 'stop_times.txt', 'trips.txt']
+cached_tables = ['trips', 'routes', 'agency']
+
+def gtfs_file_hash(gtfs_dir, table):
+    file_hash = hashlib.sha256()
+    with open_gtfs_file(gtfs_dir, table, binary=True) as f:
+        while chunk := f.read(1 << 20):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def cache_key(files):
+    # a string that identifies the GTFS files by their content and the cache format
+    return hashlib.sha256(json.dumps([cache_version, sorted((name, file['sha256']) for name, file in files.items())]).encode()).hexdigest()
+
+def load_gtfs_cache(gtfs_dir, cache_dir):
+    # return value: feed, or None if there is no cache of the current GTFS files
+    meta_file = path.join(cache_dir, 'gtfs-cache.json')
+    data_file = path.join(cache_dir, 'gtfs-cache.npz')
+    if not path.exists(meta_file) or not path.exists(data_file):
+        print(f"No GTFS cache in {cache_dir}")
+        return None
+    with open(meta_file, encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta['version'] != cache_version or sorted(meta['files']) != sorted(cached_files):
+        print("GTFS cache is from another version of this script")
+        return None
+    rehashed = False
+    for name, cached in meta['files'].items():
+        table = path.splitext(name)[0]
+        size, mtime_ns = gtfs_file_stat(gtfs_dir, table)
+        if (size, mtime_ns) == (cached['size'], cached['mtime_ns']):
+            continue
+        # the file was modified or copied, check if the content is the same
+        if size != cached['size'] or gtfs_file_hash(gtfs_dir, table) != cached['sha256']:
+            print(f"GTFS cache is out of date: {name} was changed")
+            return None
+        cached['mtime_ns'] = mtime_ns
+        rehashed = True
+
+    print(f"Loading GTFS cache {data_file}")
+    with np.load(data_file) as data:
+        if str(data['key']) != meta['key']:
+            print("GTFS cache does not match its .json file")
+            return None
+
+        def strings(key):
+            table = data[f'{key}:strings'].tolist()
+            return [table[i] for i in data[f'{key}:index'].tolist()]
+
+        def columns(table):
+            names = data[f'{table}:columns'].tolist()
+            return names, [strings(f'{table}:{name}') for name in names]
+
+        def sequences(key):
+            stop_ids = strings(f'{key}:stops')
+            offsets = data[f'{key}:offsets'].tolist()
+            return [stop_ids[start:end] for start, end in zip(offsets, offsets[1:])]
+
+        feed = {'gtfs_dir': gtfs_dir, 'tables': {}}
+        # stops
+        names, values = columns('stops')
+        has_city = data['stops:has_city'].tolist()
+        all_stops = {}
+        for stop_values, stop_has_city, city in zip(zip(*values), has_city, strings('stops:city')):
+            stop = dict(zip(names, stop_values))
+            if stop_has_city:
+                stop['city'] = city
+            all_stops[stop['stop_id']] = stop
+        feed['stops_by_stop_id'] = all_stops
+        feed['train_stops_by_stop_id'] = {stop_id: all_stops[stop_id] for stop_id in strings('train_stops')}
+        # stop_times
+        feed['stop_ids'] = strings('stop_ids')
+        feed['trip_ids'] = strings('trip_ids')
+        for key in ['stop_pattern_by_trip', 'stop_pattern_offsets', 'stop_pattern_stops']:
+            feed[key] = data[key]
+        feed['train_sequence_by_trip_id'] = dict(zip(strings('train_sequence_by_trip_id:trip_id'), map(tuple, sequences('train_sequence_by_trip_id'))))
+        # other files
+        for table in cached_tables:
+            feed['tables'][table] = columns(table)
+
+    if rehashed:
+        # save the new modification times, to not hash the files again next time
+        write_json_atomically(meta, meta_file)
+    return feed
+
+def save_gtfs_cache(feed, cache_dir):
+    gtfs_dir = feed['gtfs_dir']
+    meta_file = path.join(cache_dir, 'gtfs-cache.json')
+    data_file = path.join(cache_dir, 'gtfs-cache.npz')
+    print(f"Saving GTFS cache {data_file}")
+    files = {}
+    for name in cached_files:
+        table = path.splitext(name)[0]
+        size, mtime_ns = gtfs_file_stat(gtfs_dir, table)
+        files[name] = {'size': size, 'mtime_ns': mtime_ns, 'sha256': gtfs_file_hash(gtfs_dir, table)}
+    meta = {'version': cache_version, 'key': cache_key(files), 'files': files}
+
+    data = {'key': np.array(meta['key'])}
+
+    def add_strings(key, values):
+        data[f'{key}:strings'], data[f'{key}:index'] = np.unique(np.array(values, dtype=str), return_inverse=True)
+        data[f'{key}:index'] = data[f'{key}:index'].astype(np.int32)
+
+    def add_columns(table, names, columns):
+        data[f'{table}:columns'] = np.array(names, dtype=str)
+        for name, values in zip(names, columns):
+            add_strings(f'{table}:{name}', values)
+
+    def add_sequences(key, sequences):
+        add_strings(f'{key}:stops', [stop_id for sequence in sequences for stop_id in sequence])
+        data[f'{key}:offsets'] = np.cumsum([0] + [len(sequence) for sequence in sequences], dtype=np.int64)
+
+    all_stops = feed['stops_by_stop_id']
+    names = [name for name in next(iter(all_stops.values()), {}) if name != 'city']
+    add_columns('stops', names, [[stop[name] for stop in all_stops.values()] for name in names])
+    data['stops:has_city'] = np.array(['city' in stop for stop in all_stops.values()], dtype=bool)
+    add_strings('stops:city', [stop.get('city', '') for stop in all_stops.values()])
+    add_strings('train_stops', list(feed['train_stops_by_stop_id']))
+    add_strings('stop_ids', feed['stop_ids'])
+    add_strings('trip_ids', feed['trip_ids'])
+    for key in ['stop_pattern_by_trip', 'stop_pattern_offsets', 'stop_pattern_stops']:
+        data[key] = feed[key]
+    add_strings('train_sequence_by_trip_id:trip_id', list(feed['train_sequence_by_trip_id']))
+    add_sequences('train_sequence_by_trip_id', list(feed['train_sequence_by_trip_id'].values()))
+    for table in cached_tables:
+        add_columns(table, *feed['tables'][table])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{data_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(tmp_file, data_file)
+    write_json_atomically(meta, meta_file)
+
+def write_json_atomically(obj, out_file):
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_file, out_file)
+### end GTFS cache ###
+
+light_rail_stop_desc_re = re.compile(r'רחוב: מסילת (ברזל |קו )')
+
+def stops_from_shapes(feed, shapes, trains, train_data):
+    # return value: stops_in_regions - boolean array of which stops (by stop number, see load_gtfs) are within each shape, one row per shape
+    # if trains is True, stops_in_regions will have a single row with the stops of all train stations and nothing else (shapes are not used)
+    # (with a database: the stops of all train and light rail routes)
+    # this function also adds to train_data:
+    # stops_by_stop_id: dict mapping stop_id to stop struct
+    all_stops = feed['stops_by_stop_id']
+    train_data['stops_by_stop_id'] = feed['train_stops_by_stop_id']
+    # stop numbers of stops that are not in stops.txt come after all_stops
+    stops_in_regions = np.zeros((1 if trains else len(shapes), len(feed['stop_ids'])), dtype=bool)
+    if trains and 'database' in feed:
+        stop_ids = rail_stop_ids(feed)
+        stops_in_regions[0] = [stop_id in stop_ids for stop_id in feed['stop_ids']]
+        return stops_in_regions
+    if trains:
+        train_stop_ids = feed['train_stops_by_stop_id']
+        # add light rail stops as well
+        # eventually replace this bullshit logic with querying route_type over SQL instead of going by stops
+        # but right now, this is the easiest way
+        stops_in_regions[0, :len(all_stops)] = [stop_id in train_stop_ids or bool(light_rail_stop_desc_re.match(stop['stop_desc'])) for stop_id, stop in all_stops.items()]
+        return stops_in_regions
+
+    # add stops in the shapes
+    lons = np.array([float(stop['stop_lon']) for stop in all_stops.values()])
+    lats = np.array([float(stop['stop_lat']) for stop in all_stops.values()])
+    if len(shapes) == 1:
+        shapely.prepare(shapes[0])
+        stops_in_regions[0, :len(all_stops)] = shapely.contains_xy(shapes[0], lons, lats)
+    else:
+        # use a spatial index of the shapes to find the shapes that contain each stop
+        tree = shapely.STRtree(shapes)
+        stop_numbers, shape_indexes = tree.query(shapely.points(lons, lats), predicate='within')
+        stops_in_regions[shape_indexes, stop_numbers] = True
+    return stops_in_regions
 
-def route_ids_from_trip_ids(gtfs_dir, internal_trip_ids, connecting_trip_ids, train_data, cities_by_trip_id):
+def stop_patterns_from_stops(feed, stops_in_regions, train_data):
     # return values:
+    # 1. regions_by_stop_pattern - list with a list of (region, internal) for each stop pattern (see load_gtfs), for the regions (rows of stops_in_regions) it has stops in:
+    #    internal is True if the pattern only has stops in the region, False if it has other stops as well (i.e. its trips connect to other districts/regions)
+    # 2. cities_by_stop_pattern - list with the cities of the stops of each stop pattern as a bitmask (bit i is city_names[i]), 0 if the pattern is not in any region
+    # 3. city_names - sorted list of the names of all cities
+    # this function also adds to train_data:
+    # sequence_by_trip_id - dict mapping trip_id to a tuple of the stop_ids in its route
+    # active_trip_ids - set of the trip_ids of the trains that run on the active dates, or None for all of them (see drop_inactive_trips)
+    all_stops = feed['stops_by_stop_id']
+    train_data['sequence_by_trip_id'] = dict(feed['train_sequence_by_trip_id'])
+    train_data['active_trip_ids'] = feed.get('active_train_trip_ids')
+    offsets = feed['stop_pattern_offsets']
+    pattern_count = len(offsets) - 1
+
+    # which regions each stop pattern has stops in, and which regions it has all of its stops in
+    pattern_stops_in_regions = stops_in_regions[:, feed['stop_pattern_stops']]
+    if pattern_count:
+        any_in_regions = np.logical_or.reduceat(pattern_stops_in_regions, offsets[:-1], axis=1).T
+        all_in_regions = np.logical_and.reduceat(pattern_stops_in_regions, offsets[:-1], axis=1).T
+    else:
+        any_in_regions = all_in_regions = np.zeros((0, len(stops_in_regions)), dtype=bool)
+
+    # cities are bits, so that the cities of a route are collected with | instead of set unions
+    city_names = sorted({stop['city'] for stop in all_stops.values() if 'city' in stop})
+    city_bits = {city: 1 << i for i, city in enumerate(city_names)}
+    city_bits_by_stop = [city_bits[stop['city']] if 'city' in stop else 0 for stop in all_stops.values()] + [0] * (len(feed['stop_ids']) - len(all_stops))
+    regions_by_stop_pattern = [[] for _ in range(pattern_count)]
+    cities_by_stop_pattern = [0] * pattern_count
+    for stop_pattern in np.flatnonzero(any_in_regions.any(axis=1)).tolist():
+        all_in = all_in_regions[stop_pattern]
+        regions_by_stop_pattern[stop_pattern] = [(region, bool(all_in[region])) for region in np.flatnonzero(any_in_regions[stop_pattern]).tolist()]
+        cities = 0
+        for stop_number in feed['stop_pattern_stops'][offsets[stop_pattern]:offsets[stop_pattern + 1]].tolist():
+            cities |= city_bits_by_stop[stop_number]
+        cities_by_stop_pattern[stop_pattern] = cities
+    return regions_by_stop_pattern, cities_by_stop_pattern, city_names
+
+def city_names_from_bits(cities, city_names):
+    # return value: list of the names of the cities in the bitmask cities, in the order of city_names
+    names = []
+    while cities:
+        city_bit = cities & -cities
+        names.append(city_names[city_bit.bit_length() - 1])
+        cities ^= city_bit
+    return names
+
+def count_trips_by_region(feed, regions_by_stop_pattern, region_count):
+    # return value: list with a tuple (internal trips, connecting trips) with the number of trips of each region
+    trip_count_by_stop_pattern = np.bincount(feed['stop_pattern_by_trip'], minlength=len(regions_by_stop_pattern)).tolist()
+    trip_counts_by_region = [[0, 0] for _ in range(region_count)]
+    for trip_count, regions in zip(trip_count_by_stop_pattern, regions_by_stop_pattern):
+        for region, internal in regions:
+            trip_counts_by_region[region][0 if internal else 1] += trip_count
+    return trip_counts_by_region
+
+def route_ids_from_stop_patterns(feed, regions_by_stop_pattern, cities_by_stop_pattern, region_count, train_data):
+    # return value: list with a tuple (route_info, internal_route_ids) for each region:
     # 1. route_info: a dict where the key is route_id and the value is a tuple: (direction_id, trip_headsign, cities)
-    #    where cities is a frozenset of the names of cities the route visits
+    #    where cities is a bitmask of the cities the route visits (see stop_patterns_from_stops)
     # 2. internal_route_ids: set of route_ids belonging to internal routes
     # all routes have the same direction_id for all trips (base assumption for Israel GTFS)
     # almost all routes have the same trip_headsign for all trips, with the only exception being
@@ -153,76 +705,81 @@ def route_ids_from_trip_ids(gtfs_dir, internal_trip_ids, connecting_trip_ids, tr
 
     # this function also adds to train_data:
     # trip_by_trip_id: dict mapping trip_id to trip struct
-    route_info = {}
-    internal_route_ids = set()
-    connecting_route_ids = set()
+    route_info_by_region = [{} for _ in range(region_count)]
+    internal_route_ids_by_region = [set() for _ in range(region_count)]
+    connecting_route_ids_by_region = [set() for _ in range(region_count)]
+    # the stop patterns of the trips of each route, for the cities of the route
+    stop_patterns_by_route_id_by_region = [defaultdict(set) for _ in range(region_count)]
     logged_problem_routes = set()
-    relevant_trip_ids = internal_trip_ids | connecting_trip_ids
+    # the stop patterns of the trips that are in any region - only these trip_ids are looked up by string
+    in_any_region = np.array([bool(regions) for regions in regions_by_stop_pattern], dtype=bool)
+    stop_pattern_by_trip = feed['stop_pattern_by_trip']
+    relevant_trips = np.flatnonzero(in_any_region[stop_pattern_by_trip]) if len(in_any_region) else np.zeros(0, dtype=np.int64)
+    trip_ids = feed['trip_ids']
+    stop_pattern_by_trip_id = {trip_ids[trip]: stop_pattern for trip, stop_pattern in zip(relevant_trips.tolist(), stop_pattern_by_trip[relevant_trips].tolist())}
     train_trip_by_trip_id = {}
-    print("Parsing trips.txt")
-    with open(path.join(gtfs_dir, 'trips.txt'), newline='', encoding='utf_8_sig') as f:
-        csv_reader = csv.DictReader(f)
-        for trip in csv_reader:
-            if trip['trip_id'] in train_data['sequence_by_trip_id']:
-                train_trip_by_trip_id[trip['trip_id']] = trip
-            if trip['trip_id'] in relevant_trip_ids:
-                destination = trip['trip_headsign'].replace('_', ' - ')
-
-                trip_cities = frozenset(cities_by_trip_id[trip['trip_id']])
-                route_cities = trip_cities
-                # add trip cities to route_info if the route is already in route_info
-                if trip['route_id'] in route_info:
-                    # get union of route and trip cities and update route_info with the union
-                    route_cities = route_info[trip['route_id']][2]
-                    route_cities = route_cities | trip_cities
-                    route_info[trip['route_id']] = route_info[trip['route_id']][:2] + (route_cities,)
-
-                # sanity check - all trips of a single route are going to the same place
-                if trip['route_id'] not in route_info or route_info[trip['route_id']][:2] == (trip['direction_id'], destination):
-                    route_info[trip['route_id']] = (trip['direction_id'], destination, route_cities)
-                else:
-                    # route is most likely being changed (stops added/removed), so destination is different, nothing to do
-                    # ensure direction is still the same, because that is an important base assumption in Israel's GTFS
-                    assert route_info[trip['route_id']][0] == trip['direction_id'], f"Failed assumption in Israel GTFS: all trips of a route have the same direction. route_id = {trip['route_id']}"
-                    if trip['route_id'] not in logged_problem_routes:
-                        logged_problem_routes.add(trip['route_id'])
-                        print(
-                            "Route has trips with different headsigns in trips.txt: "
-                            f"route_id = {trip['route_id']}, "
-                            f"trip_headsign = {route_info[trip['route_id']][1]} or {destination}"
-                        )
-                    if not route_info[trip['route_id']][1]:
-                        # better a non-blank destination than a blank one
-                        route_info[trip['route_id']] = (trip['direction_id'], destination, route_cities)
-                if trip['trip_id'] in internal_trip_ids:
-                    internal_route_ids.add(trip['route_id'])
-                else:
-                    connecting_route_ids.add(trip['route_id'])
+    for trip in gtfs_rows(feed, 'trips'):
+        if trip['trip_id'] in train_data['sequence_by_trip_id']:
+            train_trip_by_trip_id[trip['trip_id']] = trip
+        stop_pattern = stop_pattern_by_trip_id.get(trip['trip_id'])
+        if stop_pattern is None:
+            continue
+        destination = trip['trip_headsign'].replace('_', ' - ')
+        for region, internal in regions_by_stop_pattern[stop_pattern]:
+            route_info = route_info_by_region[region]
+            stop_patterns_by_route_id_by_region[region][trip['route_id']].add(stop_pattern)
+
+            # sanity check - all trips of a single route are going to the same place
+            if trip['route_id'] not in route_info or route_info[trip['route_id']] == (trip['direction_id'], destination):
+                route_info[trip['route_id']] = (trip['direction_id'], destination)
+            else:
+                # route is most likely being changed (stops added/removed), so destination is different, nothing to do
+                # ensure direction is still the same, because that is an important base assumption in Israel's GTFS
+                assert route_info[trip['route_id']][0] == trip['direction_id'], f"Failed assumption in Israel GTFS: all trips of a route have the same direction. route_id = {trip['route_id']}"
+                if trip['route_id'] not in logged_problem_routes:
+                    logged_problem_routes.add(trip['route_id'])
+                    print(
+                        "Route has trips with different headsigns in trips.txt: "
+                        f"route_id = {trip['route_id']}, "
+                        f"trip_headsign = {route_info[trip['route_id']][1]} or {destination}"
+                    )
+                if not route_info[trip['route_id']][1]:
+                    # better a non-blank destination than a blank one
+                    route_info[trip['route_id']] = (trip['direction_id'], destination)
+            if internal:
+                internal_route_ids_by_region[region].add(trip['route_id'])
+            else:
+                connecting_route_ids_by_region[region].add(trip['route_id'])
     train_data['trip_by_trip_id'] = train_trip_by_trip_id
+    # add the cities of all stop patterns of each route, once
+    for route_info, stop_patterns_by_route_id in zip(route_info_by_region, stop_patterns_by_route_id_by_region):
+        for route_id, (direction_id, destination) in route_info.items():
+            cities = 0
+            for stop_pattern in stop_patterns_by_route_id[route_id]:
+                cities |= cities_by_stop_pattern[stop_pattern]
+            route_info[route_id] = (direction_id, destination, cities)
     # if a route has both connecting and internal trips, consider it connecting
     # (should ~never happen because all trips of a route should have the same stops)
-    internal_route_ids -= connecting_route_ids
-    return route_info, internal_route_ids
-
-def routes_from_route_ids(gtfs_dir, route_info):
-    routes = []
-    print("Parsing routes.txt")
-    with open(path.join(gtfs_dir, 'routes.txt'), newline='', encoding='utf_8_sig') as f:
-        csv_reader = csv.DictReader(f)
-        for route in csv_reader:
+    for internal_route_ids, connecting_route_ids in zip(internal_route_ids_by_region, connecting_route_ids_by_region):
+        internal_route_ids -= connecting_route_ids
+    return list(zip(route_info_by_region, internal_route_ids_by_region))
+
+def routes_from_route_ids(feed, route_info_by_region):
+    # return value: list with the routes of each route_info in route_info_by_region
+    # a route that is in several regions is copied for each of them
+    routes_by_region = [[] for _ in route_info_by_region]
+    for route in gtfs_rows(feed, 'routes'):
+        for routes, route_info in zip(routes_by_region, route_info_by_region):
             if route['route_id'] in route_info:
-                route['direction_and_headsign'] = route_info[route['route_id']][:2]
-                route['cities'] = route_info[route['route_id']][2]
-                routes.append(route)
-    return routes
+                routes.append(dict(route,
+                    direction_and_headsign=route_info[route['route_id']][:2],
+                    cities=route_info[route['route_id']][2]))
+    return routes_by_region
 
-def populate_agency_name_for_routes(gtfs_dir, routes):
+def populate_agency_name_for_routes(feed, routes):
     agency_names = {}
-    print("Parsing agency.txt")
-    with open(path.join(gtfs_dir, 'agency.txt'), newline='', encoding='utf_8_sig') as f:
-        csv_reader = csv.DictReader(f)
-        for agency in csv_reader:
-            agency_names[agency['agency_id']] = agency['agency_name']
+    for agency in gtfs_rows(feed, 'agency'):
+        agency_names[agency['agency_id']] = agency['agency_name']
     for route in routes:
         route['agency_name'] = agency_names[route['agency_id']]
 ### end GTFS parsing ###
@@ -268,7 +825,7 @@ class InvalidRouteError(ValueError):
     # used for try-except
     pass
 
-def create_ptna_routes(routes_by_catalog_number, internal_route_ids):
+def create_ptna_routes(routes_by_catalog_number, internal_route_ids, city_names):
     # return a list of route objects (dicts)
     # normal fields:
     # ref; type; comment; from; to; operator; gtfs_feed; route_id
@@ -354,7 +911,11 @@ def create_ptna_routes(routes_by_catalog_number, internal_route_ids):
                     comment += f" ([https://markav.net/line/{real_catalog_number}/ מר קו])"
                 catalog_entry['comment'] = comment
                 catalog_entry['catalog_number'] = catalog_number
-                catalog_entry['city'] = ','.join(sorted(frozenset.union(*[route['cities'] for route in routes])))
+                cities = 0
+                for route in routes:
+                    cities |= route['cities']
+                # city_names is sorted, so the names come out sorted
+                catalog_entry['city'] = ','.join(city_names_from_bits(cities, city_names))
 
             # internal
             catalog_entry['internal'] = "yes" if all(route['route_id'] in internal_route_ids for route in routes) else "no"
@@ -397,6 +958,8 @@ def create_ptna_routes(routes_by_catalog_number, internal_route_ids):
             print(f"Error: {err}")
     return catalog
 
+route_number_re = re.compile(r"\d+")
+
 def sort_catalog(catalog):
     route_type_order = {
         "train": 0,
@@ -410,13 +973,16 @@ def sort_catalog(catalog):
     }
     def sort_key(catalog_entry):
         ref = catalog_entry['ref']
-        num = re.match(r"\d+", ref).group()
-        return (route_type_order[catalog_entry['type']], int(num), catalog_entry['ref'])
-    catalog.sort(key=sort_key)
+        num = route_number_re.match(ref).group()
+        return (int(num), ref)
+    # sort each type on its own, then put them together in route_type_order
+    entries_by_type_order = defaultdict(list)
+    for catalog_entry in catalog:
+        entries_by_type_order[route_type_order[catalog_entry['type']]].append(catalog_entry)
+    catalog[:] = [catalog_entry for type_order in sorted(entries_by_type_order) for catalog_entry in sorted(entries_by_type_order[type_order], key=sort_key)]
 
-def dump_catalog(catalog, out_file):
-    with open(out_file, 'w', encoding='utf-8') as f:
-        json.dump(catalog, f, ensure_ascii=False)
+def dump_catalog(catalog, out_file, ndjson=False):
+    write_routes(catalog, out_file, ndjson)
 
 ### Train code - an absolute pain ###
 def process_train_data(train_data):
@@ -431,6 +997,12 @@ def process_train_data(train_data):
     for trip_id, trip in train_trip_by_trip_id.items():
         if trip['direction_id'] == '1':
             train_sequence_by_trip_id[trip_id] = tuple(reversed(train_sequence_by_trip_id[trip_id]))
+    index_train_sequences(train_data)
+    # the inactive trips are only needed for the order of the stations
+    if train_data['active_trip_ids'] is not None:
+        train_trip_by_trip_id = {trip_id: trip for trip_id, trip in train_trip_by_trip_id.items() if trip_id in train_data['active_trip_ids']}
+        train_data['trip_by_trip_id'] = train_trip_by_trip_id
+        print(f"{len(train_trip_by_trip_id)} active train trips")
 
     # group sequences by ref without duplicates
     train_sequences_by_ref = {}
@@ -519,6 +1091,13 @@ def map_sequence_to_route_identifier(ref, train_sequences, train_data):
     return route_identifier_by_sequence
 
 def merge_sub_sequences(sub_sequences_by_full_sequence, strict):
+    # position of each sequence in the dict, to handle sub-sequences in the same order as the dict
+    dict_order = {full_seq: i for i, full_seq in enumerate(sub_sequences_by_full_sequence)}
+    # sequences by their first stop - a sub-sequence of a sequence starts at one of its stops
+    full_sequences_by_first_stop = defaultdict(list)
+    for full_seq in sub_sequences_by_full_sequence:
+        full_sequences_by_first_stop[full_seq[0]].append(full_seq)
+
     # go from longest to shortest
     # note that sorted creates a list that will not change as the dict is mutated
     for full_seq, sub_seqs in sorted(sub_sequences_by_full_sequence.items(), reverse=True, key=lambda p: len(p[0])):
@@ -526,67 +1105,76 @@ def merge_sub_sequences(sub_sequences_by_full_sequence, strict):
             # already merged in a previous iteration of the for loop
             continue
 
-        for other_full_seq, other_sub_seqs in list(sub_sequences_by_full_sequence.items()):
-            if len(other_full_seq) >= len(full_seq):
-                # can't be a sub-sequence if it's not smaller
-                continue
-            if is_sub_sequence(other_full_seq, full_seq, strict):
-                # remove the other sequence
-                del sub_sequences_by_full_sequence[other_full_seq]
-                # concatenate lists
-                sub_seqs += other_sub_seqs
-
-def is_sub_sequence(short_seq, long_seq, strict):
+        positions = sequence_positions(full_seq)
+        candidates = [other_full_seq for stop in positions for other_full_seq in full_sequences_by_first_stop[stop]
+                      if other_full_seq in sub_sequences_by_full_sequence and other_full_seq[-1] in positions
+                      # can't be a sub-sequence if it's not smaller
+                      and len(other_full_seq) < len(full_seq)]
+        for other_full_seq in sorted(candidates, key=dict_order.get):
+            if is_sub_sequence(other_full_seq, full_seq, strict, positions):
+                # remove the other sequence and concatenate lists
+                sub_seqs += sub_sequences_by_full_sequence.pop(other_full_seq)
+
+def sequence_positions(seq):
+    # return value: dict mapping each stop to the index of its first occurrence in seq
+    positions = {}
+    for i, stop in enumerate(seq):
+        positions.setdefault(stop, i)
+    return positions
+
+def is_sub_sequence(short_seq, long_seq, strict, long_positions=None):
     # checks whether short_seq is a sub-sequence of long_seq
     # if strict is True, short_seq must appear consecutively in long_seq
-    if any(stop not in long_seq for stop in short_seq):
+    # long_positions is sequence_positions(long_seq), if it's already known
+    if long_positions is None:
+        long_positions = sequence_positions(long_seq)
+    if any(stop not in long_positions for stop in short_seq):
         return False
     if strict:
-        i = long_seq.index(short_seq[0])
-        j = long_seq.index(short_seq[-1])
+        i = long_positions[short_seq[0]]
+        j = long_positions[short_seq[-1]]
         return tuple(long_seq[i:j+1]) == tuple(short_seq)
     else:
-        return tuple(short_seq) == tuple(s for s in long_seq if s in short_seq)
+        short_stops = set(short_seq)
+        return tuple(short_seq) == tuple(s for s in long_seq if s in short_stops)
 
 def merge_same_endpoints(sub_sequences_by_full_sequence, train_data):
-    # note the use of list(sub_sequences_by_full_sequence.items())
-    # the dict sub_sequences_by_full_sequence gets mutated inside the loop
-    # so we have to make a copy of all we're going to iterate over in advance
-    # then at the start of the iteration we check if the key we're using is still valid
+    # merge all sequences that have the same first and last stops into one sequence
+    # merging keeps the endpoints of the sequences, so each group of sequences with the same endpoints is merged once,
+    # when its longest sequence comes up, in the order of the dict
+    full_sequences_by_endpoints = defaultdict(list)
+    for full_seq in sub_sequences_by_full_sequence:
+        full_sequences_by_endpoints[full_seq[0], full_seq[-1]].append(full_seq)
+
     for full_seq, sub_seqs in sorted(sub_sequences_by_full_sequence.items(), reverse=True, key=lambda p: len(p[0])):
         if full_seq not in sub_sequences_by_full_sequence:
             # already merged in a previous iteration of the for loop
             continue
 
-        # compare with all other trips
-        for other_full_seq, other_sub_seqs in list(sub_sequences_by_full_sequence.items()):
-            if other_sub_seqs == sub_seqs:
+        same_endpoints = full_sequences_by_endpoints[full_seq[0], full_seq[-1]]
+        if len(same_endpoints) == 1:
+            continue
+        del sub_sequences_by_full_sequence[full_seq]
+        merged_seq = full_seq
+        for other_full_seq in same_endpoints:
+            if other_full_seq == full_seq:
                 # don't merge with yourself
-                # we compare sub_seqs because the same list object stays associated with this sequence even after mergers
-                # as opposed to the sequence itself which is a tuple and might change
                 continue
-
-            if sequences_have_same_endpoints(full_seq, other_full_seq):
-                # remove these two
-                del sub_sequences_by_full_sequence[full_seq]
-                del sub_sequences_by_full_sequence[other_full_seq]
-
-                # concatenate lists
-                sub_seqs += other_sub_seqs
-
-                # create new route which includes all stops in both sequences
-                full_seq = merge_sequences(full_seq, other_full_seq, train_data)
-                sub_sequences_by_full_sequence[full_seq] = sub_seqs
-
-def sequences_have_same_endpoints(seq1, seq2):
-    return seq1[0] == seq2[0] and seq1[-1] == seq2[-1]
+            # concatenate lists
+            sub_seqs += sub_sequences_by_full_sequence.pop(other_full_seq)
+            # create new route which includes all stops in both sequences
+            merged_seq = merge_sequences(merged_seq, other_full_seq, train_data)
+        sub_sequences_by_full_sequence[merged_seq] = sub_seqs
+        same_endpoints[:] = [merged_seq]
 
 def merge_sequences(seq1, seq2, train_data):
-    shared_items = set(seq1) & set(seq2)
+    positions1 = sequence_positions(seq1)
+    positions2 = sequence_positions(seq2)
+    shared_items = positions1.keys() & positions2.keys()
 
-    assert len(set(seq1)) == len(seq1), "sequence should have no repeats"
-    assert len(set(seq2)) == len(seq2), "sequence should have no repeats"
-    assert sorted(shared_items, key=lambda v: seq1.index(v)) == sorted(shared_items, key=lambda v: seq2.index(v)), "shared elements should appear in the same order"
+    assert len(positions1) == len(seq1), "sequence should have no repeats"
+    assert len(positions2) == len(seq2), "sequence should have no repeats"
+    assert sorted(shared_items, key=positions1.get) == sorted(shared_items, key=positions2.get), "shared elements should appear in the same order"
 
     new_seq = []
 
@@ -602,14 +1190,14 @@ def merge_sequences(seq1, seq2, train_data):
             new_seq.append(v1)
             i1 += 1
             i2 += 1
-        elif v1 in seq2:
+        elif v1 in positions2:
             # seq2 has elements that seq1 doesn't
-            j = seq2.index(v1)
+            j = positions2[v1]
             new_seq += seq2[i2:j]
             i2 = j
-        elif v2 in seq1:
+        elif v2 in positions1:
             # seq1 has elements that seq2 doesn't
-            j = seq1.index(v2)
+            j = positions1[v2]
             new_seq += seq1[i1:j]
             i1 = j
         else:
@@ -617,8 +1205,8 @@ def merge_sequences(seq1, seq2, train_data):
             for v in seq1[i1:]:
                 if v in shared_items:
                     break
-            j1 = seq1.index(v)
-            j2 = seq2.index(v)
+            j1 = positions1[v]
+            j2 = positions2[v]
             new_seq += sort_sub_sequence(seq1[i1:j1] + seq2[i2:j2], train_data)
             i1 = j1
             i2 = j2
@@ -626,24 +1214,38 @@ def merge_sequences(seq1, seq2, train_data):
     # check our work
     assert new_seq[0] == seq1[0]
     assert new_seq[-1] == seq1[-1]
-    assert len(new_seq) == len(set(seq1) | set(seq2))
-    assert [v for v in new_seq if v in seq1] == list(seq1) # all stops are there, in the same order
-    assert [v for v in new_seq if v in seq2] == list(seq2)
+    assert len(new_seq) == len(positions1.keys() | positions2.keys())
+    assert [v for v in new_seq if v in positions1] == list(seq1) # all stops are there, in the same order
+    assert [v for v in new_seq if v in positions2] == list(seq2)
 
     return tuple(new_seq)
 
 def sort_sub_sequence(stop_ids, train_data):
     # look for a sequence that has all of these stops
     # by all accounts, such a sequence does exist
-    for seq in train_data['sequence_by_trip_id'].values():
-        if all(s in seq for s in stop_ids):
-            # jackpot
-            return tuple(s for s in seq if s in stop_ids)
+    # the first one in sequence_by_trip_id is used, found through the sets of sequence numbers of each stop (see index_train_sequences)
+    sequences = train_data['sequences']
+    sequence_numbers = set.intersection(*(train_data['sequence_numbers_by_stop_id'].get(s, set()) for s in stop_ids))
+    if sequence_numbers:
+        # jackpot
+        stop_ids = set(stop_ids)
+        return tuple(s for s in sequences[min(sequence_numbers)] if s in stop_ids)
 
     # need to look at multiple sequences to find the order between all the stops
     # sounds doable but currently not needed
     raise NotImplementedError("Expected the train data to be complete enough for easy coding")
 
+def index_train_sequences(train_data):
+    # adds to train_data:
+    # sequences: list of the values of sequence_by_trip_id
+    # sequence_numbers_by_stop_id: dict mapping stop_id to the set of indexes in sequences of the sequences that stop there
+    train_data['sequences'] = list(train_data['sequence_by_trip_id'].values())
+    sequence_numbers_by_stop_id = defaultdict(set)
+    for i, seq in enumerate(train_data['sequences']):
+        for stop_id in seq:
+            sequence_numbers_by_stop_id[stop_id].add(i)
+    train_data['sequence_numbers_by_stop_id'] = sequence_numbers_by_stop_id
+
 def make_train_route_identifier(ref, sequence, train_data):
     train_stops_by_stop_id = train_data['stops_by_stop_id']
     origin = train_stops_by_stop_id[sequence[0]]['stop_name']
@@ -656,7 +1258,32 @@ if __name__ == '__main__':
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-s", "--shape", help="geojson file containing the area to analyze")
     group.add_argument("-t", "--trains", action="store_true", help="output all train routes in the country")
-    parser.add_argument("-g", "--gtfsdir", required=True, help="directory containing the unzipped GTFS files")
-    parser.add_argument("-o", "--outfile", required=True, help="output file, json")
+    group.add_argument("-b", "--batch", nargs="+", metavar="SHAPE", help="geojson files (or directories of .geojson files) of several areas, analyzed together - creates a catalog for each in the output directory")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-g", "--gtfsdir", help="directory containing the unzipped GTFS files, or the GTFS .zip file")
+    source.add_argument("-d", "--database", help="sqlite3 database file created by PTNA for the feed, used instead of the GTFS files")
+    parser.add_argument("-o", "--outfile", required=True, help="output file, json (with --batch: output directory)")
+    parser.add_argument("--cache-dir", help="directory for a cache of the parsed GTFS files, used instead of parsing them again while they don't change")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes for parsing stop_times.txt (default: 1)")
+    parser.add_argument("--ndjson", action="store_true", help="write one route per line (newline-delimited JSON) instead of a JSON array")
+    active = parser.add_mutually_exclusive_group()
+    active.add_argument("--active-on", metavar="DATE", type=date.fromisoformat, help="only use trips that run on this date (YYYY-MM-DD), according to calendar.txt and calendar_dates.txt")
+    active.add_argument("--active-between", metavar=("FIRST", "LAST"), nargs=2, type=date.fromisoformat, help="only use trips that run on at least one day from FIRST to LAST (YYYY-MM-DD, inclusive)")
     args = parser.parse_args()
-    main(args.shape, args.trains, args.gtfsdir, args.outfile)
+    active_dates = (args.active_on, args.active_on) if args.active_on else args.active_between
+    if args.cache_dir and args.database:
+        parser.error("--cache-dir is only used with --gtfsdir")
+    if args.batch:
+        shape_files = []
+        for shape_path in args.batch:
+            if path.isdir(shape_path):
+                shape_files += sorted(path.join(shape_path, name) for name in os.listdir(shape_path) if name.endswith('.geojson'))
+            else:
+                shape_files.append(shape_path)
+        os.makedirs(args.outfile, exist_ok=True)
+        out_files = [path.join(args.outfile, path.splitext(path.basename(shape_file))[0] + '.json') for shape_file in shape_files]
+        if len(set(out_files)) != len(out_files):
+            parser.error("shape files in --batch must have different names")
+        main_batch(shape_files, False, args.gtfsdir, out_files, args.ndjson, args.cache_dir, args.database, args.jobs, active_dates)
+    else:
+        main(args.shape, args.trains, args.gtfsdir, args.outfile, args.ndjson, args.cache_dir, args.database, args.jobs, active_dates)